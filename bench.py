@@ -0,0 +1,96 @@
+import base64
+import hashlib
+import json
+import os
+import sys
+import time
+
+from blockchain import Block, Transaction, search_work, work_target
+
+
+def random_key():
+    # Same shape as a base64 encoded NIST256p key or signature
+    return base64.b64encode(os.urandom(64)).decode()
+
+
+def sample_block(transactions=100):
+    return Block(
+            time.time(),
+            "0" * 64,
+            1,
+            [
+                Transaction(i, random_key(), random_key(), i, random_key())
+                for i in range(transactions)
+            ],
+            None,
+            random_key()
+    )
+
+
+def legacy_hashrate(block, attempts):
+    # to_dict -> json.dumps -> hexdigest for every candidate, like the old miner
+    prefix = "0" * 64
+    start = time.perf_counter()
+    for work in range(attempts):
+        block.work = work
+        hashlib.sha256(block.to_json().encode()).hexdigest().startswith(prefix)
+    return attempts / (time.perf_counter() - start)
+
+
+def midstate_hashrate(block, attempts):
+    start = time.perf_counter()
+    prefix, suffix = block.work_template()
+    # an unreachable target makes search_work try every candidate
+    search_work(hashlib.sha256(prefix), suffix, work_target(256), 0, attempts)
+    return attempts / (time.perf_counter() - start)
+
+
+def bench_mining(transactions=100, attempts=20000):
+    block = sample_block(transactions)
+    legacy = legacy_hashrate(block, attempts)
+    midstate = midstate_hashrate(block, attempts)
+    print(f"[BENCH] Mining a block with {transactions} transactions, {attempts} attempts")
+    print(f"[BENCH] json pipeline: {legacy:>12,.0f} H/s")
+    print(f"[BENCH] midstate:      {midstate:>12,.0f} H/s ({midstate / legacy:.1f}x)")
+
+
+def rate(f, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        f()
+    return rounds / (time.perf_counter() - start)
+
+
+def uncached_hash(block):
+    # Block ids hash the header; drop the cached Merkle root so the tree is
+    # rebuilt from the transactions' (cached) hashes
+    block.transactions = block.transactions
+    return block.generate_hash()
+
+
+def bench_serialization(transactions=100, rounds=200):
+    block = sample_block(transactions)
+    encoded_json = block.to_json().encode()
+    encoded_bytes = block.to_bytes()
+    results = [
+        ("json", len(encoded_json),
+         rate(lambda: block.to_json().encode(), rounds),
+         rate(lambda: Block.from_dict(json.loads(encoded_json)), rounds),
+         rate(lambda: hashlib.sha256(block.to_json().encode()).digest(), rounds)),
+        ("binary", len(encoded_bytes),
+         rate(block.to_bytes, rounds),
+         rate(lambda: Block.from_bytes(encoded_bytes), rounds),
+         rate(lambda: uncached_hash(block), rounds)),
+    ]
+    print(f"[BENCH] Serializing a block with {transactions} transactions")
+    for name, size, encode, decode, digest in results:
+        print(f"[BENCH] {name:<6} {size:>8,} bytes  encode {encode:>9,.0f}/s  "
+              f"decode {decode:>9,.0f}/s  hash {digest:>9,.0f}/s")
+    cached = rate(block.generate_hash, rounds)
+    print(f"[BENCH] binary header hash with cached Merkle root: {cached:>9,.0f}/s")
+
+
+if __name__ == "__main__":
+    transactions = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    bench_mining(transactions)
+    bench_serialization(transactions)
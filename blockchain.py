@@ -1,19 +1,162 @@
-from typing import DefaultDict
-from ecdsa import SigningKey, VerifyingKey, NIST256p, BadSignatureError
+from ecdsa import SigningKey
 import hashlib
 import json
 import base64
 import multiprocessing as mp
+import os
+import struct
+import time
+from collections import OrderedDict
+
+from blocktree import BlockTree
+from chainindex import ChainIndex
+from encoding import COUNT, FLOAT, INT, TEXT_RAW, Reader, b64, pack_hash, pack_text
+from mempool import Mempool
+from snapshot import SnapshotStore
+from state import ChainState
+from storage import BlockStore, StoredChain
+from verify import SignatureVerifier, verify_signature
 
 BLOCK_REWARD = 100
+SNAPSHOT_INTERVAL = 1000  # blocks between account state snapshots of a stored chain
+SNAPSHOT_REPLAY_DEPTH = 100  # blocks replayed on top of a snapshot, so the tip can still be rolled back
+BLOCK_INTERVAL = 60  # seconds between blocks the difficulty aims for
+RETARGET_INTERVAL = 20  # blocks between difficulty adjustments
+MAX_TARGET = (1 << 240) - 1  # easiest allowed, 4 leading zero hex digits
+INITIAL_TARGET = (1 << 232) - 1  # 6 leading zero hex digits
+MEDIAN_TIME_SPAN = 11  # a block's timestamp must be past the median of this many before it
+MAX_FUTURE_DRIFT = 2 * 60 * 60
+MAX_BLOCK_BYTES = 1024 * 1024
+MAX_BLOCK_TRANSACTIONS = 5000
+TX_RAW = struct.Struct(">qq" + "BB64s" * 3)
+
+
+def work_target(zero_bits):
+    # A digest has `zero_bits` leading zero bits iff, compared as big-endian
+    # bytes, it sorts below 2**(256 - zero_bits).
+    if zero_bits <= 0:
+        return b"\xff" * 32 + b"\x00"  # sorts above every 32 byte digest
+    return (1 << (256 - zero_bits)).to_bytes(32, "big")
+
+
+def target_bytes(target):
+    # digest <= target as integers iff digest < target + 1 as big-endian
+    # bytes, which is cheaper to test in the mining loop
+    if target + 1 >= 1 << 256:
+        return work_target(0)
+    return (target + 1).to_bytes(32, "big")
+
+
+def block_work(target):
+    # Expected number of hashes to find a block meeting target
+    return (1 << 256) // (target + 1)
+
+
+def retarget(target, height, timestamp_at):
+    # Target for the block at height, given its parent's. Every
+    # RETARGET_INTERVAL blocks it scales with how long the last interval
+    # took compared to BLOCK_INTERVAL per block, by at most 4x either way.
+    # timestamp_at(h) is the timestamp of the ancestor at height h.
+    if height % RETARGET_INTERVAL or height < RETARGET_INTERVAL:
+        return target
+    first, last = max(1, height - RETARGET_INTERVAL - 1), height - 1
+    expected = BLOCK_INTERVAL * (last - first)
+    actual = min(max(timestamp_at(last) - timestamp_at(first), expected / 4), expected * 4)
+    return max(1, min(target * round(actual * 1000) // round(expected * 1000), MAX_TARGET))
+
+
+def search_work(midstate, suffix, target, start, end):
+    # midstate is a sha256 object that has already absorbed the block prefix
+    copy = midstate.copy
+    pack = INT.pack
+    for work in range(start, end):
+        h = copy()
+        h.update(pack(work) + suffix)
+        if h.digest() < target:
+            return work
+    return None
+
+
+def _mine_worker(pid, prefix, suffix, target, chunk_size, counter, found, stop_event):
+    # hash objects can't be pickled, so every process builds its own midstate
+    midstate = hashlib.sha256(prefix)
+    while not stop_event.is_set():
+        # allocate a chunk atomically
+        with counter.get_lock():
+            base = counter.value
+            counter.value += chunk_size
+
+        work = search_work(midstate, suffix, target, base, base + chunk_size)
+        if work is not None:
+            with found.get_lock():
+                if found.value == -1:
+                    found.value = work
+            stop_event.set()
+            print(f"[P{pid}] FOUND work={work}")
+
+
+def merkle_levels(hashes):
+    # Pairwise sha256 of the leaf digests up to the root, carrying an odd one
+    # out up a level by pairing it with itself
+    levels = [list(hashes)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level.append(level[-1])
+        levels.append([hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)])
+    return levels
+
+
+def merkle_root(hashes):
+    if not hashes:
+        return "0" * 64
+    return merkle_levels(hashes)[-1][0].hex()
+
+
+def merkle_proof(hashes, index):
+    # Sibling hashes from the leaf up, each tagged with the side it sits on
+    proof = []
+    for level in merkle_levels(hashes)[:-1]:
+        sibling = index ^ 1
+        proof.append([level[sibling].hex(), "left" if sibling < index else "right"])
+        index //= 2
+    return proof
+
+
+def verify_merkle_proof(leaf, proof, root):
+    h = leaf
+    for sibling, side in proof:
+        sibling = bytes.fromhex(sibling)
+        h = hashlib.sha256(sibling + h if side == "left" else h + sibling).digest()
+    return h.hex() == root
+
 
 class Transaction:
-    def __init__(self, nonce, sender, recipient, amount, signature):
-        self.sender = sender
-        self.recipient = recipient
-        self.amount = amount
-        self.signature = signature
-        self.nonce = nonce
+    # Immutable value type: the encoding, signing hash and txid are computed
+    # at most once, and equality and hashing go by txid
+    __slots__ = ("nonce", "sender", "recipient", "amount", "signature",
+                 "_bytes", "_hash", "_txid", "_py_hash")
+
+    def __init__(self, nonce, sender, recipient, amount, signature, _bytes=None):
+        setattr_ = object.__setattr__
+        setattr_(self, "nonce", nonce)
+        setattr_(self, "sender", sender)
+        setattr_(self, "recipient", recipient)
+        setattr_(self, "amount", amount)
+        setattr_(self, "signature", signature)
+        setattr_(self, "_bytes", _bytes)
+        setattr_(self, "_hash", None)
+        setattr_(self, "_txid", None)
+        setattr_(self, "_py_hash", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Transaction is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Transaction is immutable")
+
+    def __reduce__(self):
+        return Transaction, (self.nonce, self.sender, self.recipient, self.amount, self.signature)
 
     @staticmethod
     def from_dict(data):
@@ -42,37 +185,78 @@ class Transaction:
     def to_internal_json(self):
         return json.dumps(self.to_internal_dict())
 
+    def to_internal_bytes(self):
+        return (
+            INT.pack(self.nonce)
+            + INT.pack(self.amount)
+            + pack_text(self.sender)
+            + pack_text(self.recipient)
+        )
+
+    def to_bytes(self):
+        if self._bytes is None:
+            object.__setattr__(self, "_bytes", self.to_internal_bytes() + pack_text(self.signature))
+        return self._bytes
+
+    @staticmethod
+    def read(reader):
+        # Fast path for the usual shape: raw 64 byte keys and signature. That
+        # layout is canonical, so the input bytes double as the encoding.
+        if reader.pos + TX_RAW.size <= len(reader.data):
+            nonce, amount, t1, n1, sender, t2, n2, recipient, t3, n3, signature = \
+                TX_RAW.unpack_from(reader.data, reader.pos)
+            if t1 == t2 == t3 == TEXT_RAW and n1 == n2 == n3 == 64:
+                encoded = bytes(reader.take(TX_RAW.size))
+                return Transaction(nonce, b64(sender), b64(recipient), amount, b64(signature), encoded)
+        nonce = reader.unpack(INT)
+        amount = reader.unpack(INT)
+        sender = reader.text()
+        recipient = reader.text()
+        return Transaction(nonce, sender, recipient, amount, reader.text())
+
+    @staticmethod
+    def from_bytes(data):
+        reader = Reader(data)
+        transaction = Transaction.read(reader)
+        reader.done()
+        return transaction
+
     def generate_hash(self):
-        return hashlib.sha256(self.to_internal_json().encode()).digest()
+        # What gets signed, so it leaves out the signature
+        if self._hash is None:
+            object.__setattr__(self, "_hash", hashlib.sha256(self.to_internal_bytes()).digest())
+        return self._hash
+
+    @property
+    def txid(self):
+        if self._txid is None:
+            object.__setattr__(self, "_txid", hashlib.sha256(self.to_bytes()).digest())
+        return self._txid
 
     def check_signature(self):
-        if not self.signature or not self.sender:
-            return False
-        try:
-            verifying_key = VerifyingKey.from_string(
-                    base64.b64decode(self.sender),
-                    curve=NIST256p
-            )
-            verifying_key.verify(
-                    base64.b64decode(self.signature),
-                    self.generate_hash()
-            )
-            return True
-        except (BadSignatureError, ValueError):
-            return False
+        return verify_signature(self.sender, self.signature, self.generate_hash())
 
     def sign_transaction(self, private_key: SigningKey):
+        # Returns the signed transaction, this one can't be changed
         h = self.generate_hash()
         signature = private_key.sign(h)
-        self.signature = base64.b64encode(signature).decode()
+        return Transaction(
+            self.nonce,
+            self.sender,
+            self.recipient,
+            self.amount,
+            base64.b64encode(signature).decode()
+        )
 
     def __eq__(self, value: object, /) -> bool:
         if isinstance(value, Transaction):
-            return self.to_external_dict() == value.to_external_dict()
+            return self.txid == value.txid
         return False
 
     def __hash__(self):
-        return hash(json.dumps(self.to_external_dict()))
+        if self._py_hash is None:
+            object.__setattr__(self, "_py_hash", hash(self.txid))
+        return self._py_hash
 
     def __str__(self):
         return json.dumps(self.to_external_dict())
@@ -81,6 +265,81 @@ class Transaction:
         return self.__str__()
 
 
+class BlockHeader:
+    def __init__(self, timestamp, prev_hash, nonce, merkle_root, work, reward_to):
+        self.prev_hash = prev_hash
+        self.timestamp = timestamp
+        self.nonce = nonce
+        self.merkle_root = merkle_root
+        self.work = work
+        self.reward_to = reward_to
+
+    @staticmethod
+    def from_dict(data):
+        return BlockHeader(
+            data["timestamp"],
+            data["prev_hash"],
+            data["nonce"],
+            data["merkle_root"],
+            data["work"],
+            data["reward_to"]
+        )
+
+    def to_dict(self):
+        return {
+            "prev_hash": self.prev_hash,
+            "nonce": self.nonce,
+            "timestamp": self.timestamp,
+            "merkle_root": self.merkle_root,
+            "work": self.work,
+            "reward_to": self.reward_to
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def to_bytes(self):
+        # work goes last so everything before it is a fixed mining prefix
+        return (
+            pack_hash(self.prev_hash)
+            + INT.pack(self.nonce)
+            + FLOAT.pack(self.timestamp)
+            + bytes.fromhex(self.merkle_root)
+            + pack_text(self.reward_to)
+            + INT.pack(-1 if self.work is None else self.work)
+        )
+
+    @staticmethod
+    def from_bytes(data):
+        reader = Reader(data)
+        prev_hash = reader.hash()
+        nonce = reader.unpack(INT)
+        timestamp = reader.unpack(FLOAT)
+        merkle_root = reader.take(32).hex()
+        reward_to = reader.text()
+        work = reader.unpack(INT)
+        reader.done()
+        return BlockHeader(timestamp, prev_hash, nonce, merkle_root, None if work == -1 else work, reward_to)
+
+    def generate_hash(self):
+        return hashlib.sha256(self.to_bytes()).hexdigest()
+
+    def work_template(self):
+        # The prefix is hashed once and the sha256 state reused for every
+        # candidate work, which is the last 8 bytes of the header
+        return self.to_bytes()[:-INT.size], b""
+
+    def check_work(self, target):
+        digest = hashlib.sha256(self.to_bytes()).digest()
+        return int.from_bytes(digest, "big") <= target
+
+    def __str__(self):
+        return self.to_json()
+
+    def __repr__(self):
+        return self.to_json()
+
+
 class Block:
     def __init__(self, timestamp, prev_hash, nonce, transactions, work, reward_to):
         self.prev_hash = prev_hash
@@ -90,6 +349,17 @@ class Block:
         self.work = work
         self.reward_to = reward_to
 
+    @property
+    def transactions(self):
+        return self._transactions
+
+    @transactions.setter
+    def transactions(self, transactions):
+        # The root is cached, so the transactions must be replaced rather
+        # than mutated in place
+        self._transactions = transactions
+        self._merkle_root = None
+
     @staticmethod
     def from_dict(data):
         return Block(
@@ -114,68 +384,110 @@ class Block:
     def to_json(self):
         return json.dumps(self.to_dict())
 
+    def to_bytes(self):
+        return b"".join([
+            pack_hash(self.prev_hash),
+            INT.pack(self.nonce),
+            FLOAT.pack(self.timestamp),
+            pack_text(self.reward_to),
+            INT.pack(-1 if self.work is None else self.work),
+            COUNT.pack(len(self.transactions)),
+        ] + [transaction.to_bytes() for transaction in self.transactions])
+
+    @staticmethod
+    def from_bytes(data):
+        reader = Reader(data)
+        prev_hash = reader.hash()
+        nonce = reader.unpack(INT)
+        timestamp = reader.unpack(FLOAT)
+        reward_to = reader.text()
+        work = reader.unpack(INT)
+        transactions = [Transaction.read(reader) for _ in range(reader.unpack(COUNT))]
+        reader.done()
+        return Block(timestamp, prev_hash, nonce, transactions, None if work == -1 else work, reward_to)
+
+    def merkle_root(self):
+        if self._merkle_root is None:
+            # Leaves are txids, which cover the signature, so no two different
+            # sets of transactions share a root
+            self._merkle_root = merkle_root([transaction.txid for transaction in self.transactions])
+        return self._merkle_root
+
+    def has_duplicates(self):
+        # An odd level repeats its last leaf, so [t0, t1, t2, t2] would have
+        # the same root as [t0, t1, t2]
+        return len({transaction.txid for transaction in self.transactions}) != len(self.transactions)
+
+    def merkle_proof(self, index):
+        return merkle_proof([transaction.txid for transaction in self.transactions], index)
+
+    @staticmethod
+    def from_header(header, transactions):
+        return Block(
+            header.timestamp,
+            header.prev_hash,
+            header.nonce,
+            transactions,
+            header.work,
+            header.reward_to
+        )
+
+    def header(self):
+        return BlockHeader(
+            self.timestamp,
+            self.prev_hash,
+            self.nonce,
+            self.merkle_root(),
+            self.work,
+            self.reward_to
+        )
+
     def generate_hash(self):
-        return hashlib.sha256(self.to_json().encode()).hexdigest()
+        # A block is identified by its header alone, so a header chain can be
+        # checked for proof of work without any transactions
+        return self.header().generate_hash()
 
-    def check_work(self, n):
-        h = self.generate_hash()
-        return h.startswith('0' * n)
+    def work_template(self):
+        return self.header().work_template()
+
+    def check_work(self, target):
+        return self.header().check_work(target)
 
-    def single_thread_mine(self, n, start=0):
-        i = start 
+    def single_thread_mine(self, target, start=0, chunk_size=50000):
+        prefix, suffix = self.work_template()
+        midstate = hashlib.sha256(prefix)
+        target = target_bytes(target)
+        i = start
         while True:
-            self.work = i
-            print(f"[MINE] Trying work: {i}")
-            if self.check_work(n):
+            print(f"[MINE] Trying work: {i}-{i + chunk_size - 1}")
+            work = search_work(midstate, suffix, target, i, i + chunk_size)
+            if work is not None:
+                self.work = work
                 break
-            i += 1
+            i += chunk_size
 
-    def multi_process_mine(self, n, start=0, processes=None, chunk_size=50000):
+    def multi_process_mine(self, target, start=0, processes=None, chunk_size=50000):
         if processes is None:
             processes = mp.cpu_count()
-    
+
+        prefix, suffix = self.work_template()
+        target = target_bytes(target)
+
         # signed long long sentinel = -1 means "not found yet"
         counter = mp.Value('q', start)      # shared atomic counter
         found = mp.Value('q', -1)           # stores found work or -1
         stop_event = mp.Event()             # tells workers to stop
-    
-        def worker(pid):
-            # local copy of self inside process (pickled). Faster access than Manager proxies.
-            local = self
-            while not stop_event.is_set():
-                # allocate a chunk atomically
-                with counter.get_lock():
-                    base = counter.value
-                    counter.value += chunk_size
-                end = base + chunk_size
-    
-                for candidate in range(base, end):
-                    if stop_event.is_set():
-                        break
-    
-                    # temporarily set candidate on local copy and call check_work
-                    prev = getattr(local, 'work', None)
-                    local.work = candidate
-                    try:
-                        if local.check_work(n):
-                            found.value = candidate
-                            stop_event.set()
-                            print(f"[P{pid}] FOUND work={candidate}")
-                            break
-                    finally:
-                        # restore previous value to avoid side-effects in this process
-                        if prev is None:
-                            try: delattr(local, 'work')
-                            except Exception: pass
-                        else:
-                            local.work = prev
-    
+
         procs = []
         for pid in range(processes):
-            p = mp.Process(target=worker, args=(pid,), daemon=True)
+            p = mp.Process(
+                    target=_mine_worker,
+                    args=(pid, prefix, suffix, target, chunk_size, counter, found, stop_event),
+                    daemon=True
+            )
             p.start()
             procs.append(p)
-    
+
         try:
             for p in procs:
                 p.join()
@@ -184,13 +496,13 @@ class Block:
             for p in procs:
                 p.terminate()
                 p.join()
-    
+
         if found.value != -1:
             # set parent object's work to the found nonce
             self.work = found.value
             return True
         return False
-    
+
     def __str__(self):
         return self.to_json()
 
@@ -198,104 +510,533 @@ class Block:
         return self.to_json()
 
 
+class BlockTemplate:
+    # The next block to mine on top of a chain's tip. Transactions are only
+    # taken if they fit the size limits, come after the sender's earlier ones
+    # in the template and are covered by what the sender has left, so the
+    # template stays minable as transactions are added while mining.
+    def __init__(self, chain, reward_to, max_bytes=MAX_BLOCK_BYTES, max_count=MAX_BLOCK_TRANSACTIONS):
+        self.chain = chain
+        self.reward_to = reward_to
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.prev_hash = chain.get_last_hash()
+        self.nonce = chain.get_last_block().nonce + 1
+        self.target = chain.next_target()
+        self.transactions = []
+        self.size = 0
+        self.spent = {}       # sender -> amount already spent in the template
+        self.last_nonce = {}  # sender -> nonce of their last transaction in it
+        self.stale = False    # set once the chain tip moves on
+        self.block = None
+        self._rebuild()
+
+    def _rebuild(self):
+        # A new Block object every time, so a block handed to the miner
+        # never changes underneath it
+        self.block = Block(
+                time.time(),
+                self.prev_hash,
+                self.nonce,
+                list(self.transactions),
+                None,
+                self.reward_to
+        )
+
+    def _include(self, transaction):
+        size = len(transaction.to_bytes())
+        if len(self.transactions) >= self.max_count or self.size + size > self.max_bytes:
+            return False
+        sender = transaction.sender
+        if transaction.nonce < self.chain.nonces.get(sender, 0):
+            return False
+        if sender in self.last_nonce and transaction.nonce <= self.last_nonce[sender]:
+            return False
+        balance = self.chain.balances.get(sender, 0) - self.spent.get(sender, 0)
+        if not balance or balance < transaction.amount:
+            return False
+        if not self.chain.verifier.check(transaction):
+            return False
+        self.transactions.append(transaction)
+        self.size += size
+        self.spent[sender] = self.spent.get(sender, 0) + transaction.amount
+        self.last_nonce[sender] = transaction.nonce
+        return True
+
+    def fill(self, transactions):
+        added = sum(self._include(transaction) for transaction in transactions)
+        if added:
+            self._rebuild()
+        return added
+
+    def add(self, transaction):
+        return self.fill([transaction]) > 0
+
+
+def encode_block(block):
+    return block.to_bytes()
+
+
+def decode_block(data):
+    return Block.from_bytes(data)
+
+
+def encode_header(block):
+    return block.header().to_bytes()
+
+
 class Blockchain:
-    def __init__(self):
-        self.chain = [
-                Block(
-                    1752211185.0440528,
-                    None,
-                    0,
-                    [],
-                    None,
-                    "kfdyqoMmZMFage+R02jDm5d2jpsbd9iAt4Lj5Jh9Yv+cOMNjvo7gJbf2wM2CJXLyAGnGEwhZp/+QpjkOzfrnNA=="
-            )
-        ]
-        self.balances = DefaultDict(int)
-        self.nonces = DefaultDict(int)
-        self.nonces[None] += 1
-        self.mempool = set() 
-        self.index_balances()
+    def __init__(self, store=None, snapshot_interval=SNAPSHOT_INTERVAL):
+        genesis = Block(
+                1752211185.0440528,
+                None,
+                0,
+                [],
+                None,
+                "kfdyqoMmZMFage+R02jDm5d2jpsbd9iAt4Lj5Jh9Yv+cOMNjvo7gJbf2wM2CJXLyAGnGEwhZp/+QpjkOzfrnNA=="
+        )
+        self.snapshot_interval = snapshot_interval
+        self.snapshots = None
+        if store is None:
+            self.chain = [genesis]
+            self.index = ChainIndex()
+        else:
+            self.chain = StoredChain(store, encode_block, decode_block, encode_header)
+            if not len(self.chain):
+                self.chain.append(genesis)
+            self.index = ChainIndex(os.path.join(store.directory, "index.sqlite"))
+            self.snapshots = SnapshotStore(os.path.join(store.directory, "snapshots"))
+        self.mempool = Mempool()
+        self.verifier = SignatureVerifier()
+        self.side = BlockTree()
+        if not self.load_state():
+            self.nonces[None] += 1  # Snapshots already include this
+            if self.snapshots is not None and self.state.height - SNAPSHOT_REPLAY_DEPTH >= self.snapshot_interval:
+                # Spare the next start the full replay, from deep enough
+                # below the tip for load_state to use it
+                self.snapshots.save(self.state.snapshot(SNAPSHOT_REPLAY_DEPTH))
+        self.update_index()
 
-    def index_balances(self):
+    def save(self, directory):
+        # Copy the chain into a fresh block store; from then on add_block
+        # appends to it as blocks arrive
+        if isinstance(self.chain, StoredChain):
+            if os.path.abspath(self.chain.store.directory) == os.path.abspath(directory):
+                return
+        store = BlockStore(directory)
+        store.truncate(0)
         for block in self.chain:
-            for transaction in block.transactions:
-                if not transaction.check_signature() and not block.nonce == 0:
+            store.append(encode_block(block), encode_header(block))
+        self.chain = StoredChain(store, encode_block, decode_block, encode_header)
+        self.index = ChainIndex(os.path.join(directory, "index.sqlite"))
+        self.update_index()
+        self.snapshots = SnapshotStore(os.path.join(directory, "snapshots"))
+        if self.state.can_rollback(SNAPSHOT_REPLAY_DEPTH):
+            self.snapshots.save(self.state.snapshot(SNAPSHOT_REPLAY_DEPTH))
+
+    @property
+    def balances(self):
+        return self.state.balances
+
+    @property
+    def nonces(self):
+        return self.state.nonces
+
+    def load_state(self):
+        # Start from the newest snapshot that matches the chain and replay
+        # only the blocks after it. Returns whether a snapshot was used.
+        if self.snapshots is not None:
+            for snapshot in self.snapshots.newest():
+                # There is no undo data below a snapshot, so one too close to
+                # the tip would leave no room to reorganize
+                if len(self.chain) - snapshot["height"] < SNAPSHOT_REPLAY_DEPTH:
+                    continue
+                try:
+                    self.index_balances(snapshot)
+                except ValueError as e:
+                    print(f"[CHAIN] Skipping snapshot at height {snapshot['height']}: {e}")
                     continue
-                self.balances[transaction.recipient] += transaction.amount
-                self.balances[transaction.sender] -= transaction.amount
-            self.balances[block.reward_to] += BLOCK_REWARD
+                print(f"[CHAIN] Loaded state snapshot at height {snapshot['height']}, "
+                      f"replayed {len(self.chain) - snapshot['height']} block(s)")
+                return True
+        self.index_balances()
+        return False
+
+    def index_balances(self, snapshot=None):
+        # Rebuild balances and nonces from a state snapshot, or from genesis.
+        # Blocks in self.chain were validated when added, so only the deltas
+        # are replayed.
+        if snapshot is None:
+            self.state = ChainState(BLOCK_REWARD)
+        else:
+            height = snapshot["height"]
+            if height > len(self.chain) or self.chain[height - 1].generate_hash() != snapshot["tip_hash"]:
+                raise ValueError("Snapshot does not match the chain")
+            self.state = ChainState.from_snapshot(snapshot, BLOCK_REWARD)
+        # Main chain blocks a fork could still branch off from, by hash, with
+        # their height and target
+        self.recent = OrderedDict()
+        if self.state.height:
+            self.recent[self.state.tip_hash] = (self.state.height - 1, self.state.target)
+        for height in range(self.state.height, len(self.chain)):
+            block = self.chain[height]
+            if height:
+                target = retarget(self.state.target, height, lambda h: self.chain[h].timestamp)
+            else:
+                target = INITIAL_TARGET
+            block_hash = block.generate_hash()
+            self.state.apply_block(block, block_hash, block_work(target), target)
+            self._remember(block_hash, height, target)
+
+    def update_index(self):
+        # Bring the lookup index in line with the chain, e.g. after a crash
+        # between storing a block and indexing it
+        height = min(self.index.height, len(self.chain))
+        while height and self.index.block_hash(height - 1) != self.chain[height - 1].generate_hash():
+            height -= 1
+        self.index.truncate(height)
+        for height in range(height, len(self.chain)):
+            block = self.chain[height]
+            self.index.add_block(height, block.generate_hash(), block)
+
+    def get_transaction(self, txid):
+        # (transaction, height, position) of a transaction on the main chain
+        location = self.index.transaction_location(txid)
+        if location is None:
+            return None
+        height, position = location
+        return self.chain[height].transactions[position], height, position
+
+    def get_block_height(self, block_hash):
+        return self.index.block_height(block_hash)
+
+    def get_address_history(self, address, start=0, limit=1000):
+        return self.index.address_history(address, start, limit)
+
+    def _remember(self, block_hash, height, target):
+        self.recent[block_hash] = (height, target)
+        while len(self.recent) > self.state.max_undo + 1:
+            self.recent.popitem(last=False)
+
+    def build_template(self, reward_to, max_bytes=MAX_BLOCK_BYTES, max_count=MAX_BLOCK_TRANSACTIONS):
+        template = BlockTemplate(self, reward_to, max_bytes, max_count)
+        template.fill(self.mempool.select())
+        return template
+
+    def get_block_bytes(self, height):
+        # Stored blocks are served straight from disk without decoding them
+        if isinstance(self.chain, StoredChain):
+            return self.chain.store.read(height)
+        return self.chain[height].to_bytes()
+
+    def get_header_bytes(self, height):
+        # Stored headers too, which spares hashing every transaction again
+        if isinstance(self.chain, StoredChain):
+            return self.chain.store.read_header(height)
+        return self.chain[height].header().to_bytes()
 
     def get_last_block(self):
         return self.chain[-1]
 
     def get_last_hash(self):
-        return self.get_last_block().generate_hash()
+        return self.state.tip_hash
+
+    def validate_block(self, block, check_signatures=True):
+        # 0) Validate block fits the size limits
+        if not self.valid_size(block):
+            print("Block validation failed: Block is too large")
+            return False
+
+        if block.has_duplicates():
+            print("Block validation failed: Duplicate transaction")
+            return False
 
-    def validate_block(self, block):
         # 1) Validate block nonce is +1 of the previous block
         if not self.get_last_block().nonce + 1 == block.nonce:
             print("Block validation failed: Nonce is not +1 of previous block")
+            return False
 
         # 2) Validate block previous hash points to the correct previous block
         if not block.prev_hash == self.get_last_hash():
             print("Block validation failed: Previous hash does not point to correct previous block")
             return False
 
-        # 3) Validate block has POW
-        if not block.check_work(6):
+        # 3) Validate block has POW for the current difficulty, and a
+        # timestamp that can't be used to game it
+        if not block.check_work(self.next_target()):
             print("Block validation failed: Not enough proof of work")
             return False
+        height = len(self.chain)
+        if not self.valid_timestamp(block.timestamp, height, lambda h: self.chain[h].timestamp):
+            print("Block validation failed: Invalid timestamp")
+            return False
 
         # 4) Validate every transaction in the block
         for transaction in block.transactions:
-            if not self.validate_transaction(transaction, True):
+            if not self.validate_transaction(transaction, True, False):
                 return False
+
+        # 5) Validate every signature, across the verifier's processes for big blocks
+        if check_signatures and not self.verifier.verify(block.transactions):
+            print("Block validation failed: Transaction signature is invalid")
+            return False
         return True
 
-    def validate_transaction(self, transaction, skip_mempool=False):
-        # 1) Validate signature
-        if not transaction.check_signature():
-            print("Transaction validation failed: Transaction signature is invalid")
+    @staticmethod
+    def valid_size(block):
+        if len(block.transactions) > MAX_BLOCK_TRANSACTIONS:
+            return False
+        return sum(len(transaction.to_bytes()) for transaction in block.transactions) <= MAX_BLOCK_BYTES
+
+    def validate_headers(self, headers, start=0):
+        # Check that headers follow each other from a block we know, on the
+        # main chain or a side branch, with enough work. headers[:start]
+        # passed already, e.g. as an earlier batch of a download.
+        parent = self.locate_block(headers[0].prev_hash)
+        if parent is None:
+            print("Header validation failed: Unknown parent block")
+            return False
+        fork_hash = prev_hash = headers[0].prev_hash
+        fork_height, _, prev_nonce, target = parent
+
+        def timestamp_at(h):
+            if h > fork_height:
+                return headers[h - fork_height - 1].timestamp
+            return self.timestamp_at(fork_hash, h)
+
+        if start:
+            prev_hash, prev_nonce = headers[start - 1].generate_hash(), headers[start - 1].nonce
+        for height, header in enumerate(headers, fork_height + 1):
+            target = retarget(target, height, timestamp_at)
+            if height <= fork_height + start:
+                continue  # Checked already, only its target is needed
+            if header.prev_hash != prev_hash or header.nonce != prev_nonce + 1:
+                print("Header validation failed: Header does not extend the previous one")
+                return False
+            if not header.check_work(target):
+                print("Header validation failed: Not enough proof of work")
+                return False
+            if not self.valid_timestamp(header.timestamp, height, timestamp_at):
+                print("Header validation failed: Invalid timestamp")
+                return False
+            prev_hash = header.generate_hash()
+            prev_nonce = header.nonce
+        return True
+
+    def header_targets(self, headers):
+        # Targets of headers that follow a known block, like validate_headers
+        fork_hash = headers[0].prev_hash
+        fork_height, _, _, target = self.locate_block(fork_hash)
+
+        def timestamp_at(h):
+            if h > fork_height:
+                return headers[h - fork_height - 1].timestamp
+            return self.timestamp_at(fork_hash, h)
+
+        targets = []
+        for height in range(fork_height + 1, fork_height + 1 + len(headers)):
+            target = retarget(target, height, timestamp_at)
+            targets.append(target)
+        return targets
+
+    def valid_timestamp(self, timestamp, height, timestamp_at):
+        # Later than the median of the blocks before it and not too far ahead
+        # of our clock, so a miner can't skew the retargeting much
+        if timestamp > time.time() + MAX_FUTURE_DRIFT:
             return False
+        if height <= 1:
+            return True
+        previous = sorted(timestamp_at(h) for h in range(max(1, height - MEDIAN_TIME_SPAN), height))
+        return timestamp > previous[len(previous) // 2]
+
+    def timestamp_at(self, block_hash, height):
+        # Timestamp of the ancestor at height of a main chain or side block
+        entry = self.side.get(block_hash)
+        while entry is not None:
+            block, block_height = entry[0], entry[1]
+            if block_height == height:
+                return block.timestamp
+            entry = self.side.get(block.prev_hash)
+        return self.chain[height].timestamp  # Below the branch it is the main chain
+
+    def next_target(self, parent_hash=None):
+        # Target of a block on top of parent_hash, by default our tip
+        if parent_hash is None:
+            parent_hash = self.get_last_hash()
+        height, _, _, target = self.locate_block(parent_hash)
+        return retarget(target, height + 1, lambda h: self.timestamp_at(parent_hash, h))
+
+    def knows_block(self, block_hash):
+        # On the main chain, however deep, or on a side branch
+        return (block_hash in self.recent or block_hash in self.side
+                or self.index.block_height(block_hash) is not None)
+
+    def check_header_work(self, header):
+        # Cheap first check of a block we were sent: its parent's difficulty
+        # if we know the parent, the easiest allowed one otherwise
+        if self.locate_block(header.prev_hash) is None:
+            return header.check_work(MAX_TARGET)
+        return header.check_work(self.next_target(header.prev_hash))
+
+    def locate_block(self, block_hash):
+        # (height, cumulative work, nonce, target) of a recent main chain
+        # block or a side block, None if we don't know it
+        entry = self.side.get(block_hash)
+        if entry is not None:
+            block, height, work, target = entry
+            return height, work, block.nonce, target
+        entry = self.recent.get(block_hash)
+        if entry is None:
+            return None
+        height, target = entry
+        # Its work is the tip's minus that of the blocks above it
+        work = self.state.work
+        for above, above_target in reversed(self.recent.values()):
+            if above <= height:
+                break
+            work -= block_work(above_target)
+        return height, work, self.chain[height].nonce, target
+
+    def branch_work(self, headers):
+        # Cumulative work at the end of headers, which follow a known block
+        return self.locate_block(headers[0].prev_hash)[1] + sum(map(block_work, self.header_targets(headers)))
+
+    def accept_block(self, block, check_signatures=True):
+        # Fork choice: extend the tip, keep the block on a side branch, or
+        # switch to its branch once that has more work than the main chain.
+        # Returns "extended", "side", "reorg", "known", "orphan" if we don't
+        # know its parent, "bad_branch" if an earlier block of its branch
+        # turned out invalid, or None if the block itself was rejected. A
+        # branch forking off too deep to switch to stays a "side" branch.
+        block_hash = block.generate_hash()
+        if self.knows_block(block_hash):
+            return "known"
+        if block.prev_hash == self.get_last_hash():
+            if not self.validate_block(block, check_signatures):
+                return None
+            self.add_block(block)
+            self.side.prune(len(self.chain) - self.state.max_undo)
+            return "extended"
+
+        parent = self.locate_block(block.prev_hash)
+        if parent is None:
+            print("Block validation failed: Unknown parent block")
+            return "orphan"
+        height, work, nonce, _ = parent
+        target = self.next_target(block.prev_hash)
+        if (block.nonce != nonce + 1 or block.has_duplicates() or not block.check_work(target) or not self.valid_timestamp(
+                block.timestamp, height + 1, lambda h: self.timestamp_at(block.prev_hash, h))):
+            print("Block validation failed: Invalid side branch block")
+            return None
+        # Transactions are only checked against the branch's state if it wins
+        work += block_work(target)
+        self.side.add(block_hash, block, height + 1, work, target)
+        if work <= self.state.work:
+            return "side"
+        result = self.reorganize(block_hash)
+        return "side" if result == "too_deep" else result
+
+    def reorganize(self, tip_hash):
+        # Switch the main chain over to the side branch ending at tip_hash.
+        # Returns "reorg", "too_deep", "bad_branch" if a block before
+        # tip_hash is invalid, or None if the tip_hash block itself is.
+        branch = self.side.branch(tip_hash)
+        fork = self.recent.get(branch[0][1].prev_hash, (None,))[0]
+        depth = len(self.chain) - 1 - fork if fork is not None else None
+        if depth is None or not self.state.can_rollback(depth):
+            print("[CHAIN] Cannot reorganize, the fork is too deep")
+            return "too_deep"
+        print(f"[CHAIN] Reorganizing: replacing {depth} block(s) with {len(branch)}")
+        old_targets = [target for height, target in self.recent.values() if height > fork]
+        # Their transactions go back to the mempool, the branch's come out of it
+        old = self.rollback_to(fork + 1)
+        fork_work = self.state.work
+        for i, (block_hash, block) in enumerate(branch):
+            if not self.validate_block(block):
+                print("[CHAIN] Branch is invalid, restoring the previous chain")
+                for bad_hash, _ in branch[i:]:
+                    self.side.discard(bad_hash)
+                self.rollback_to(fork + 1)
+                for old_block in reversed(old):
+                    self.add_block(old_block)
+                return None if block_hash == tip_hash else "bad_branch"
+            self.add_block(block)
 
-        # 2) Validate transaction balance
+        for block_hash, _ in branch:
+            self.side.discard(block_hash)
+        # The old blocks become a side branch that may still win later
+        work = fork_work
+        for height, (block, target) in enumerate(zip(reversed(old), old_targets), fork + 1):
+            work += block_work(target)
+            self.side.add(block.generate_hash(), block, height, work, target)
+        return "reorg"
+
+    def validate_transaction(self, transaction, skip_mempool=False, check_signature=True):
+        # Cheapest checks first, the signature only once everything else passed
+
+        # 1) Validate transaction balance
         sender = self.balances.get(transaction.sender)
         if not sender or not sender >= transaction.amount:
             print("Transaction validation failed: Insufficient balance")
             return False
 
-        # 3) Validate transaction nonce
+        # 2) Validate transaction nonce
         if not self.nonces[transaction.sender] <= transaction.nonce:
             print("Transaction validation failed: Invalid nonce")
             return False
 
-        # 4) Make sure transaction is not in the mempool
-        if skip_mempool:
-            return True
-        for tx in self.mempool:
-            if tx.sender == transaction.sender and tx.nonce == transaction.nonce:
-                print("Transaction validation failed: Duplicate nonce in mempool")
-                return False
+        # 3) Make sure transaction is not in the mempool
+        if not skip_mempool and self.mempool.has_nonce(transaction.sender, transaction.nonce):
+            print("Transaction validation failed: Duplicate nonce in mempool")
+            return False
+
+        # 4) Validate signature, unless this node has verified it before
+        if check_signature and not self.verifier.check(transaction):
+            print("Transaction validation failed: Transaction signature is invalid")
+            return False
 
         return True
 
     def add_block(self, block):
+        # Remove transactions from mempool
         for transaction in block.transactions:
-            # Remove transactions from mempool
-            if transaction in self.mempool:
-                self.mempool.remove(transaction)
-
-            self.balances[transaction.recipient] += transaction.amount
-            self.balances[transaction.sender] -= transaction.amount
-            self.nonces[transaction.sender] = transaction.nonce 
+            self.mempool.discard(transaction)
 
-        self.balances[block.reward_to] += BLOCK_REWARD
+        block_hash = block.generate_hash()
+        target = self.next_target()
+        self.state.apply_block(block, block_hash, block_work(target), target)
+        self._remember(block_hash, len(self.chain), target)
+        self.index.add_block(len(self.chain), block_hash, block)
         print(block.reward_to)
 
         self.chain.append(block)
+        # Snapshot the state SNAPSHOT_REPLAY_DEPTH blocks back, one at the tip
+        # would leave no room to reorganize after loading it
+        height = self.state.height - SNAPSHOT_REPLAY_DEPTH
+        if self.snapshots is not None and height > 0 and height % self.snapshot_interval == 0 \
+                and self.state.can_rollback(SNAPSHOT_REPLAY_DEPTH):
+            self.snapshots.save(self.state.snapshot(SNAPSHOT_REPLAY_DEPTH))
+
+    def rollback_block(self):
+        if len(self.chain) == 1:
+            raise ValueError("Cannot roll back the genesis block")
+        self.state.rollback_block()
+        self.recent.popitem()
+        block = self.chain.pop()
+        self.index.truncate(len(self.chain))
+        # The block's transactions are unconfirmed again
+        for transaction in block.transactions:
+            self.mempool.add(transaction)
+        return block
+
+    def rollback_to(self, height):
+        rolled_back = []
+        while len(self.chain) > height:
+            rolled_back.append(self.rollback_block())
+        return rolled_back
 
     def add_transaction(self, transaction):
-        self.mempool.add(transaction)
+        return self.mempool.add(transaction)
 
     def __str__(self) -> str:
         return f"Blockchain(chain={self.chain}, mempool={self.mempool})"
@@ -0,0 +1,39 @@
+class BlockTree:
+    # Blocks off the main chain by hash, each with its height, target and the
+    # cumulative work of the branch it ends. When full the lowest blocks are
+    # dropped first, they are the least likely to ever win.
+    def __init__(self, max_blocks=2000):
+        self.max_blocks = max_blocks
+        self.blocks = {}  # hash -> (block, height, work, target)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, block_hash):
+        return self.blocks.get(block_hash)
+
+    def add(self, block_hash, block, height, work, target):
+        self.blocks[block_hash] = (block, height, work, target)
+        if len(self.blocks) > self.max_blocks:
+            lowest = min(self.blocks, key=lambda h: self.blocks[h][1])
+            del self.blocks[lowest]
+
+    def discard(self, block_hash):
+        self.blocks.pop(block_hash, None)
+
+    def branch(self, tip_hash):
+        # The side blocks leading up to tip_hash, oldest first
+        branch = []
+        while tip_hash in self.blocks:
+            block = self.blocks[tip_hash][0]
+            branch.append((tip_hash, block))
+            tip_hash = block.prev_hash
+        branch.reverse()
+        return branch
+
+    def prune(self, min_height):
+        for block_hash in [h for h, entry in self.blocks.items() if entry[1] < min_height]:
+            del self.blocks[block_hash]
@@ -0,0 +1,81 @@
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (hash BLOB PRIMARY KEY, height INTEGER NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS transactions (txid BLOB PRIMARY KEY, height INTEGER NOT NULL, position INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS transactions_height ON transactions (height);
+CREATE TABLE IF NOT EXISTS addresses (
+    address TEXT NOT NULL, height INTEGER NOT NULL, position INTEGER NOT NULL, txid BLOB NOT NULL,
+    PRIMARY KEY (address, height, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS addresses_height ON addresses (height);
+"""
+
+
+class ChainIndex:
+    # Lookup tables over the main chain: block hash -> height, txid ->
+    # (height, position) and address -> txids. Kept in SQLite next to the
+    # block store and updated block by block, so nothing has to be replayed.
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        if self.path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    @property
+    def height(self):
+        # Number of blocks indexed
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(MAX(height) + 1, 0) FROM blocks").fetchone()[0]
+
+    def add_block(self, height, block_hash, block):
+        transactions = []
+        addresses = []
+        for position, transaction in enumerate(block.transactions):
+            txid = transaction.txid
+            transactions.append((txid, height, position))
+            addresses.append((transaction.sender, height, position, txid))
+            addresses.append((transaction.recipient, height, position, txid))
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO blocks VALUES (?, ?)", (bytes.fromhex(block_hash), height))
+            # A transaction replayed in a later block keeps its first location
+            self.db.executemany("INSERT OR IGNORE INTO transactions VALUES (?, ?, ?)", transactions)
+            self.db.executemany("INSERT OR IGNORE INTO addresses VALUES (?, ?, ?, ?)", addresses)
+
+    def truncate(self, height):
+        # Forget every block from height up, e.g. when rolling back the tip
+        with self.lock, self.db:
+            for table in ("blocks", "transactions", "addresses"):
+                self.db.execute(f"DELETE FROM {table} WHERE height >= ?", (height,))
+
+    def block_hash(self, height):
+        with self.lock:
+            row = self.db.execute("SELECT hash FROM blocks WHERE height = ?", (height,)).fetchone()
+        return row[0].hex() if row else None
+
+    def block_height(self, block_hash):
+        with self.lock:
+            row = self.db.execute("SELECT height FROM blocks WHERE hash = ?", (bytes.fromhex(block_hash),)).fetchone()
+        return row[0] if row else None
+
+    def transaction_location(self, txid):
+        with self.lock:
+            row = self.db.execute("SELECT height, position FROM transactions WHERE txid = ?", (txid,)).fetchone()
+        return tuple(row) if row else None
+
+    def address_history(self, address, start=0, limit=1000):
+        # (txid, height, position) of the address's transactions, oldest first
+        with self.lock:
+            return self.db.execute(
+                    "SELECT txid, height, position FROM addresses WHERE address = ? "
+                    "ORDER BY height, position LIMIT ? OFFSET ?",
+                    (address, limit, start)
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,80 @@
+import binascii
+import struct
+
+# Building blocks of the canonical binary encoding of blocks and transactions.
+# Integers are fixed width and big-endian. Text fields (addresses and
+# signatures) are tagged: base64 strings are stored as their raw bytes, so a
+# 64 byte key costs 66 bytes instead of 88 characters.
+TEXT_NONE = 0
+TEXT_RAW = 1
+TEXT_UTF8 = 2
+
+INT = struct.Struct(">q")
+COUNT = struct.Struct(">I")
+FLOAT = struct.Struct(">d")
+LENGTH = struct.Struct(">H")
+
+
+def pack_text(value):
+    if value is None:
+        return b"\x00"
+    try:
+        raw = binascii.a2b_base64(value)
+        # Only canonical base64 encodes back to the exact same string
+        if len(raw) <= 255 and binascii.b2a_base64(raw, newline=False) == value.encode():
+            return bytes((TEXT_RAW, len(raw))) + raw
+    except (ValueError, binascii.Error):
+        pass
+    data = value.encode()
+    return bytes((TEXT_UTF8,)) + LENGTH.pack(len(data)) + data
+
+
+def b64(raw):
+    return binascii.b2a_base64(raw, newline=False).decode()
+
+
+def pack_hash(value):
+    # Optional 32 byte hash given as hex, e.g. the genesis block's prev_hash
+    if value is None:
+        return b"\x00"
+    return b"\x01" + bytes.fromhex(value)
+
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def take(self, n):
+        end = self.pos + n
+        if end > len(self.data):
+            raise ValueError("Truncated data")
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def unpack(self, fmt):
+        if self.pos + fmt.size > len(self.data):
+            raise ValueError("Truncated data")
+        value = fmt.unpack_from(self.data, self.pos)[0]
+        self.pos += fmt.size
+        return value
+
+    def text(self):
+        tag = self.take(1)[0]
+        if tag == TEXT_NONE:
+            return None
+        if tag == TEXT_RAW:
+            return b64(self.take(self.take(1)[0]))
+        if tag == TEXT_UTF8:
+            return self.take(self.unpack(LENGTH)).decode()
+        raise ValueError(f"Unknown text tag {tag}")
+
+    def hash(self):
+        if not self.take(1)[0]:
+            return None
+        return self.take(32).hex()
+
+    def done(self):
+        if self.pos != len(self.data):
+            raise ValueError("Trailing data")
@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+
+# Inventory items are ("block", hash hex) or ("tx", txid hex)
+
+
+def block_item(block_hash):
+    return ("block", block_hash)
+
+
+def tx_item(txid):
+    return ("tx", txid.hex())
+
+
+class SeenCache:
+    # Bounded set of recently seen inventory, forgetting the oldest first
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, item):
+        return item in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, item):
+        # True if the item was not in the cache yet
+        with self.lock:
+            if item in self.entries:
+                self.entries.move_to_end(item)
+                return False
+            self.entries[item] = None
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return True
+
+    def discard(self, item):
+        with self.lock:
+            self.entries.pop(item, None)
+
+
+class PeerInventory:
+    # What each peer is known to have, because it told us about it or we
+    # sent it to them, so nothing is sent to a peer twice. Only the most
+    # recently active max_peers peers are remembered.
+    def __init__(self, max_per_peer=50000, max_peers=256):
+        self.max_per_peer = max_per_peer
+        self.max_peers = max_peers
+        self.known = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, peer, item):
+        # True if the peer was not known to have the item yet
+        with self.lock:
+            known = self.known.get(peer)
+            if known is None:
+                known = self.known[peer] = SeenCache(self.max_per_peer)
+                while len(self.known) > self.max_peers:
+                    self.known.popitem(last=False)
+            else:
+                self.known.move_to_end(peer)
+        return known.add(item)
+
+    def forget(self, peer):
+        with self.lock:
+            self.known.pop(peer, None)
+
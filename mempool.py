@@ -0,0 +1,158 @@
+import bisect
+import heapq
+import itertools
+import threading
+
+# For reconciliation txids are bucketed by their leading bytes; each bucket is
+# summarized by its size and the XOR of its txids' last 8 bytes
+TAIL = slice(-8, None)
+
+
+class Mempool:
+    # Unconfirmed transactions indexed by txid and by (sender, nonce), with
+    # each sender's transactions kept in nonce order.
+    #
+    # Transactions carry no fee, so when the pool is full the eviction policy
+    # decides what goes: "largest_sender" drops the highest nonce of whoever
+    # has the most transactions queued (one sender can't crowd out everyone
+    # else), "oldest" drops the earliest arrival.
+    def __init__(self, max_size=50000, eviction="largest_sender"):
+        if eviction not in ("largest_sender", "oldest"):
+            raise ValueError(f"Unknown eviction policy {eviction}")
+        self.max_size = max_size
+        self.eviction = eviction
+        self.by_txid = {}
+        self.by_sender = {}  # sender -> {nonce: transaction}
+        self.nonces = {}     # sender -> sorted list of queued nonces
+        self.arrival = {}    # txid -> sequence number
+        self.seq = itertools.count()
+        self.sender_heap = []  # (-queued count, sequence, sender), lazily updated
+        self.buckets = [set() for _ in range(256)]  # txids by first byte
+        self.bucket_sums = [0] * 256
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.by_txid)
+
+    def __iter__(self):
+        return iter(list(self.by_txid.values()))
+
+    def __contains__(self, transaction):
+        return transaction.txid in self.by_txid
+
+    def get(self, txid):
+        return self.by_txid.get(txid)
+
+    def has_nonce(self, sender, nonce):
+        return nonce in self.by_sender.get(sender, ())
+
+    def for_sender(self, sender):
+        with self.lock:
+            queued = self.by_sender.get(sender, {})
+            return [queued[nonce] for nonce in self.nonces.get(sender, [])]
+
+    def add(self, transaction):
+        with self.lock:
+            if transaction.txid in self.by_txid or self.has_nonce(transaction.sender, transaction.nonce):
+                return False
+            self.by_txid[transaction.txid] = transaction
+            self._bucket(transaction.txid).add(transaction.txid)
+            self.arrival[transaction.txid] = next(self.seq)
+            self.by_sender.setdefault(transaction.sender, {})[transaction.nonce] = transaction
+            bisect.insort(self.nonces.setdefault(transaction.sender, []), transaction.nonce)
+            self._track_sender(transaction.sender)
+
+            while len(self.by_txid) > self.max_size:
+                if self._evict() is transaction:
+                    return False
+            return True
+
+    def discard(self, transaction):
+        with self.lock:
+            transaction = self.by_txid.pop(transaction.txid, None)
+            if transaction is None:
+                return False
+            del self.arrival[transaction.txid]
+            self._bucket(transaction.txid).discard(transaction.txid)
+            queued = self.by_sender[transaction.sender]
+            del queued[transaction.nonce]
+            nonces = self.nonces[transaction.sender]
+            del nonces[bisect.bisect_left(nonces, transaction.nonce)]
+            if not queued:
+                del self.by_sender[transaction.sender]
+                del self.nonces[transaction.sender]
+            else:
+                self._track_sender(transaction.sender)
+            return True
+
+    remove = discard
+
+    def _bucket(self, txid):
+        # Adding and removing a txid both flip its tail in the bucket sum
+        self.bucket_sums[txid[0]] ^= int.from_bytes(txid[TAIL], "big")
+        return self.buckets[txid[0]]
+
+    def sketch(self, prefix=b""):
+        # (count, tail XOR) of each of the 256 buckets one byte below prefix.
+        # Equal summaries mean the same txids in that bucket, bar a 64 bit
+        # collision, so peers only need to look closer where they differ.
+        with self.lock:
+            if not prefix:
+                return [(len(bucket), total) for bucket, total in zip(self.buckets, self.bucket_sums)]
+            depth = len(prefix)
+            counts = [0] * 256
+            sums = [0] * 256
+            for txid in self.buckets[prefix[0]]:
+                if txid.startswith(prefix):
+                    counts[txid[depth]] += 1
+                    sums[txid[depth]] ^= int.from_bytes(txid[TAIL], "big")
+            return list(zip(counts, sums))
+
+    def inventory(self, prefix=b""):
+        with self.lock:
+            txids = self.buckets[prefix[0]] if prefix else self.by_txid
+            return [txid for txid in txids if txid.startswith(prefix)]
+
+    def _track_sender(self, sender):
+        heapq.heappush(self.sender_heap, (-len(self.nonces[sender]), next(self.seq), sender))
+        if len(self.sender_heap) > 4 * len(self.nonces) + 64:
+            # Too many stale entries, rebuild from the live counts
+            self.sender_heap = [(-len(nonces), next(self.seq), s) for s, nonces in self.nonces.items()]
+            heapq.heapify(self.sender_heap)
+
+    def _evict(self):
+        if self.eviction == "oldest":
+            # arrival keeps insertion order, so its first key is the oldest
+            victim = self.by_txid[next(iter(self.arrival))]
+        else:
+            while True:
+                count, _, sender = heapq.heappop(self.sender_heap)
+                # Skip entries made stale by later adds and removals
+                if sender in self.nonces and -count == len(self.nonces[sender]):
+                    break
+            victim = self.by_sender[sender][self.nonces[sender][-1]]
+        self.discard(victim)
+        print(f"[MEMPOOL] Evicted transaction {victim.txid.hex()[:16]}")
+        return victim
+
+    def select(self, limit=None):
+        # Transactions for a new block, each sender's in nonce order and
+        # senders interleaved by the arrival of their next transaction
+        with self.lock:
+            heads = []
+            for sender, nonces in self.nonces.items():
+                tx = self.by_sender[sender][nonces[0]]
+                heads.append((self.arrival[tx.txid], sender, 0))
+            heapq.heapify(heads)
+            selected = []
+            while heads and (limit is None or len(selected) < limit):
+                _, sender, i = heapq.heappop(heads)
+                nonces = self.nonces[sender]
+                selected.append(self.by_sender[sender][nonces[i]])
+                if i + 1 < len(nonces):
+                    tx = self.by_sender[sender][nonces[i + 1]]
+                    heapq.heappush(heads, (self.arrival[tx.txid], sender, i + 1))
+            return selected
+
+    def __repr__(self):
+        return repr(list(self.by_txid.values()))
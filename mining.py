@@ -0,0 +1,159 @@
+import hashlib
+import multiprocessing as mp
+import queue
+import time
+
+from blockchain import search_work, target_bytes
+
+IDLE = 0
+
+
+def _pool_worker(pid, jobs, results, counter, current_job, hashes, chunk_size):
+    while True:
+        job = jobs.get()
+        # Skip templates that were replaced while we were busy
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                break
+        if job is None:
+            return
+
+        job_id, prefix, suffix, target = job
+        midstate = hashlib.sha256(prefix)
+        while True:
+            # allocate a chunk atomically, unless the job has been replaced
+            with counter.get_lock():
+                if current_job.value != job_id:
+                    break
+                base = counter.value
+                counter.value += chunk_size
+
+            work = search_work(midstate, suffix, target, base, base + chunk_size)
+            # a found work ends the scan early, which is close enough for a rate
+            hashes[pid] += chunk_size if work is None else work - base + 1
+            if work is not None:
+                results.put((job_id, work))
+                print(f"[P{pid}] FOUND work={work}")
+                break
+
+
+class MiningPool:
+    def __init__(self, processes=None, chunk_size=10000):
+        self.processes = processes or mp.cpu_count()
+        self.chunk_size = chunk_size
+        self.counter = mp.Value('q', 0)
+        self.current_job = mp.Value('q', IDLE)
+        self.hashes = mp.Array('q', self.processes)
+        self.results = mp.Queue()
+        self.jobs = []
+        self.workers = []
+        self.job_id = IDLE
+        self.job_started = None
+        self.job_ended = None
+        self.job_hashes = [0] * self.processes
+
+    def start(self):
+        if self.workers:
+            return
+        for pid in range(self.processes):
+            jobs = mp.Queue()
+            p = mp.Process(
+                    target=_pool_worker,
+                    args=(pid, jobs, self.results, self.counter, self.current_job,
+                          self.hashes, self.chunk_size),
+                    daemon=True
+            )
+            p.start()
+            self.jobs.append(jobs)
+            self.workers.append(p)
+        print(f"[MINE] Started mining pool with {self.processes} worker(s)")
+
+    def submit(self, block, target, start=0):
+        self.start()
+        prefix, suffix = block.work_template()
+        self.job_id += 1
+        self.job_started = time.time()
+        self.job_ended = None
+        self.job_hashes = list(self.hashes)
+        with self.counter.get_lock():
+            self.counter.value = start
+            self.current_job.value = self.job_id
+        for jobs in self.jobs:
+            jobs.put((self.job_id, prefix, suffix, target_bytes(target)))
+        return self.job_id
+
+    def cancel(self):
+        with self.counter.get_lock():
+            if self.current_job.value == IDLE:
+                return False
+            self.current_job.value = IDLE
+        self.job_ended = time.time()
+        print("[MINE] Cancelled in-flight work")
+        return True
+
+    def wait(self, job_id, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while self.current_job.value == job_id:
+            if deadline is not None and time.time() > deadline:
+                return None
+            try:
+                found_job, work = self.results.get(timeout=0.1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if found_job != job_id:
+                continue
+            with self.counter.get_lock():
+                if self.current_job.value == job_id:
+                    self.current_job.value = IDLE
+            self.job_ended = time.time()
+            return work
+        return None
+
+    def _check_workers(self):
+        # A worker that died (e.g. it crashed importing the main module
+        # under spawn) would leave wait() polling forever
+        dead = [p for p in self.workers if not p.is_alive()]
+        if not dead:
+            return
+        self.cancel()
+        for p in self.workers:
+            p.terminate()
+        self.jobs = []
+        self.workers = []  # started again on the next submit
+        raise RuntimeError(f"{len(dead)} mining worker(s) exited, last exit code {dead[-1].exitcode}")
+
+    def is_current(self, job_id):
+        return self.current_job.value == job_id
+
+    def mine(self, block, target, start=0, timeout=None):
+        job_id = self.submit(block, target, start)
+        work = self.wait(job_id, timeout)
+        if work is None:
+            self.cancel()
+            return False
+        block.work = work
+        return True
+
+    def worker_hashrates(self):
+        if self.job_started is None:
+            return [0.0] * self.processes
+        elapsed = max((self.job_ended or time.time()) - self.job_started, 1e-9)
+        return [(h - base) / elapsed for h, base in zip(self.hashes, self.job_hashes)]
+
+    def hashrate(self):
+        return sum(self.worker_hashrates())
+
+    def total_hashes(self):
+        return sum(self.hashes)
+
+    def stop(self):
+        self.cancel()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for p in self.workers:
+            p.join()
+        self.jobs = []
+        self.workers = []
@@ -1,7 +1,53 @@
+import asyncio
 import socket
 import json
 import blockchain
+import gossip
+import mining
+import peers
+import protocol
+import random
 import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Answered straight from the event loop, everything else goes to the executor
+CHEAP_MESSAGES = {"get_height", "get_peers", "get_ping"}
+MAX_BLOCKS_PER_REQUEST = 500
+MAX_HEADERS_PER_REQUEST = 2000
+MAX_HISTORY_PER_REQUEST = 1000
+MAX_SKETCHES_PER_REQUEST = 256
+MAX_INVENTORY_PER_REQUEST = 5000
+MAX_TRANSACTIONS_PER_REQUEST = 1000
+# Mempool buckets a peer holds at most this many txids of are listed in full
+# during reconciliation instead of being split further
+RECONCILE_THRESHOLD = 32
+SYNC_OVERLAP = 100  # headers below our tip fetched again to find where a peer's chain forks off
+RELAY_CACHE_SIZE = 32  # recently relayed blocks, for peers rebuilding compact blocks
+MAX_PEERS_PER_REQUEST = 100
+MAX_BLOCKS_RESPONSE = protocol.MAX_FRAME_SIZE // 2  # bytes of blocks in one get_blocks reply, leaving room for the rest
+# Largest payloads accepted before parsing them: base64 of a full block with
+# room for its header and counts, of a transaction and of a compact block's
+# short txids
+MAX_BLOCK_MESSAGE = (blockchain.MAX_BLOCK_BYTES + 64 * 1024) * 4 // 3
+MAX_TRANSACTION_MESSAGE = 4096
+MAX_SHORT_TXIDS_MESSAGE = protocol.SHORT_TXID_SIZE * blockchain.MAX_BLOCK_TRANSACTIONS * 4 // 3 + 4
+# Messages per second and burst allowed from one peer, per message type.
+# Anything else shares DEFAULT_RATE.
+MESSAGE_RATES = {
+    "new_block": (1, 20),
+    "new_compact_block": (1, 20),
+    "new_transaction": (50, 500),
+    "new_inventory": (20, 200),
+    "get_blocks": (5, 50),
+    "get_headers": (5, 50),
+    "get_mempool": (0.2, 5),
+    "get_transactions": (5, 50),
+    "get_ping": (5, 20),
+}
+DEFAULT_RATE = (20, 200)
+PING_INTERVAL = 30  # seconds between rounds of pinging peers and topping up connections
 
 
 class Node:
@@ -9,19 +55,46 @@ class Node:
         self.host = host
         self.port = port
         self.chain = chain
-        self.peers = set()
+        self.peer_manager = peers.PeerManager()
+        self.limiter = peers.RateLimiter(MESSAGE_RATES, DEFAULT_RATE)
+        self.miner = mining.MiningPool()
+        self.template = None
+        self.connect_timeout = 3
+        self.send_timeout = 5
+        self.connections = protocol.ConnectionPool(self.connect_timeout, self.send_timeout)
+        self.broadcaster = ThreadPoolExecutor(16)  # bounds concurrent deliveries
+        self.chain_lock = threading.RLock()
+        self.sync_lock = threading.Lock()
+        self.executor = None
+        self.max_inflight = 16  # per peer, before we stop reading from it
+        self.relayed = OrderedDict()  # block hash -> block
+        self.relay_lock = threading.Lock()
+        self.seen = gossip.SeenCache()
+        self.known = gossip.PeerInventory()
+        self.in_flight = set()  # announced items we are fetching
+        self.gossip_lock = threading.Lock()
+        self.gossip_stats = Counter()
         self.load_peers()
 
+    @property
+    def peers(self):
+        # The peers we send to and download from, kept up by maintain_peers
+        return self.peer_manager.outbound
+
     def load_peers(self):
         with open("KNOWN_NODES", "r") as f:
             for line in f.readlines():
                 h = line.split(":")[0]
                 p = int(line.split(":")[1])
-                self.peers.add((h, p))
+                self.peer_manager.add_peer((h, p))
 
     # !!SERVER CODE!!
-    def start(self):
-        threading.Thread(target=self.listen_for_peers, daemon=True).start()
+    def start(self, use_asyncio=False):
+        if use_asyncio:
+            threading.Thread(target=lambda: asyncio.run(self.serve()), daemon=True).start()
+        else:
+            threading.Thread(target=self.listen_for_peers, daemon=True).start()
+        threading.Thread(target=self.maintain_peers, daemon=True).start()
 
     def listen_for_peers(self):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -37,17 +110,113 @@ class Node:
             ).start()
 
     def handle_peer(self, conn, address):
+        if self.peer_manager.is_banned(address):
+            conn.close()
+            return
         print(f"[NODE] Accepted connection from {address}")
         try:
-            data = conn.recv(4096).decode()
-            message = json.loads(data)
-            self.handle_message(message, conn)
+            # A connection stays open for any number of framed requests
+            while True:
+                message = protocol.read_frame(conn)
+                if message is None:
+                    break
+                protocol.send_frame(conn, self.admit(message, address) or self.respond(message, address))
+                if self.peer_manager.is_banned(address):
+                    print(f"[NODE] Disconnecting banned peer {address}")
+                    break
         except Exception as e:
             print("[NODE] ERROR: ", e)
         finally:
             conn.close()
 
-    def handle_message(self, message, conn):
+    def admit(self, message, address):
+        # Runs before anything else is done with a message, returns the
+        # error to answer with if it was sent too often
+        if self.limiter.allow(peers.ban_key(address), message.get("type")):
+            return None
+        self.gossip_stats["rate_limited"] += 1
+        self.punish_connection(address, 1, "rate limited")
+        return {"type": "error", "data": "Rate limited", "id": message.get("id")}
+
+    def respond(self, message, source=None):
+        # source is the address of the connection the message came in on
+        try:
+            response = self.handle_message(message, source)
+        except Exception as e:
+            print("[NODE] ERROR: ", e)
+            response = {"type": "error", "data": str(e)}
+        if response is None:
+            self.punish_connection(source, 10, "invalid message")
+            response = {"type": "error", "data": "Invalid message"}
+        response["id"] = message.get("id")
+        return response
+
+    async def serve(self, workers=8, backlog=1024):
+        self.executor = ThreadPoolExecutor(workers)
+        server = await asyncio.start_server(self.handle_peer_async, self.host, self.port, backlog=backlog)
+        print(f"[NODE] Listening on {self.host}:{self.port} (asyncio)")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_peer_async(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        if self.peer_manager.is_banned(address):
+            writer.close()
+            return
+        print(f"[NODE] Accepted connection from {address}")
+        # Backpressure: once max_inflight requests from this peer are being
+        # handled we stop reading its socket until one of them finishes
+        inflight = asyncio.Semaphore(self.max_inflight)
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(protocol.HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                payload = await reader.readexactly(protocol.decode_frame_header(header))
+                message = json.loads(payload)
+                rejected = self.admit(message, address)
+                if rejected is not None:
+                    # Answered right here, a flood never reaches the executor
+                    async with write_lock:
+                        writer.write(protocol.encode_frame(rejected))
+                        await writer.drain()
+                    if self.peer_manager.is_banned(address):
+                        print(f"[NODE] Disconnecting banned peer {address}")
+                        break
+                    continue
+                await inflight.acquire()
+                task = asyncio.create_task(self._respond_async(message, address, writer, write_lock, inflight))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except Exception as e:
+            print("[NODE] ERROR: ", e)
+        finally:
+            for task in list(tasks):
+                task.cancel()
+            writer.close()
+
+    async def _respond_async(self, message, address, writer, write_lock, inflight):
+        try:
+            if message.get("type") in CHEAP_MESSAGES:
+                response = self.respond(message, address)
+            else:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self.executor, self.respond, message, address)
+            async with write_lock:
+                writer.write(protocol.encode_frame(response))
+                await writer.drain()
+            if self.peer_manager.is_banned(address):
+                print(f"[NODE] Disconnecting banned peer {address}")
+                writer.close()
+        except (ConnectionError, protocol.ProtocolError) as e:
+            print("[NODE] ERROR: ", e)
+        finally:
+            inflight.release()
+
+    def handle_message(self, message, source=None):
         message_type = message.get("type")
         message_data = message.get("data")
         message_from = message.get("from")
@@ -58,161 +227,934 @@ class Node:
             return
         if not message_data and not message_type.startswith("get_"):
             return
-        if not message_parameter and message_type == "get_block":
+        if message_parameter is None and message_type in ("get_block", "get_blocks", "get_headers", "get_proof",
+                                                               "get_mempool_sketch", "get_inventory", "get_transactions",
+                                                               "get_block_transactions", "get_transaction",
+                                                               "get_address_history"):
             return
+        if message_from:
+            message_from = tuple(message_from)
         if message_type == "new_block":
-            self.new_block(conn, message_data, message_from)
+            return self.new_block(message_data, message_from, source)
+        if message_type == "new_compact_block":
+            return self.new_compact_block(message_data, message_from, source)
+        if message_type == "new_inventory":
+            return self.new_inventory(message_data, message_from, source)
         if message_type == "new_transaction":
-            self.new_transaction(conn, message_data, message_from)
+            return self.new_transaction(message_data, message_from, source)
         if message_type == "get_block":
-            self.get_block(conn, message_parameter)
+            return self.get_block(message_parameter)
+        if message_type == "get_blocks":
+            return self.get_blocks(message_parameter)
+        if message_type == "get_headers":
+            return self.get_headers(message_parameter)
+        if message_type == "get_proof":
+            return self.get_proof(message_parameter)
         if message_type == "get_height":
-            self.get_height(conn)
+            return self.get_height()
         if message_type == "get_mempool":
-            self.get_mempool(conn)
+            return self.get_mempool()
+        if message_type == "get_mempool_sketch":
+            return self.get_mempool_sketch(message_parameter)
+        if message_type == "get_inventory":
+            return self.get_inventory(message_parameter)
+        if message_type == "get_transactions":
+            return self.get_transactions(message_parameter)
+        if message_type == "get_block_transactions":
+            return self.get_block_transactions(message_parameter)
+        if message_type == "get_transaction":
+            return self.get_transaction(message_parameter)
+        if message_type == "get_address_history":
+            return self.get_address_history(message_parameter)
         if message_type == "get_peers":
-            self.get_peers(conn)
+            return self.get_peers()
         if message_type == "get_ping":
-            self.get_ping(conn)
+            return self.get_ping()
 
-    def new_block(self, conn, data, f):
+    def new_block(self, data, f, source=None):
+        # Checks ordered by cost: size, hash against what we know, proof of
+        # work, and only then the transactions and their signatures
+        if not isinstance(data, str) or len(data) > MAX_BLOCK_MESSAGE:
+            self.punish_connection(source, 50, "oversized block")
+            return {"type": "error", "data": "Block too large"}
         try:
-            block = blockchain.Block.from_dict(json.loads(data))
+            block = protocol.unpack(blockchain.Block, data)
         except Exception as e:
             print("[NODE] Failed to parse block: ", e)
-            conn.send(json.dumps({
-                "type": "error", "data": "Failed to parse block"
-            }).encode())
-            return
-        if not self.chain.validate_block(block):
+            self.punish_connection(source, 10, "unparsable block")
+            return {"type": "error", "data": "Failed to parse block"}
+        block_hash = block.generate_hash()
+        if self.already_seen(gossip.block_item(block_hash), f, "block", source):
+            return {"type": "ok"}
+        known, enough_work = self.check_block_header(block.header())
+        if known:
+            return {"type": "ok"}
+        if not enough_work:
+            self.punish_connection(source, 50, "block without enough work")
+            return {"type": "error", "data": "Invalid block"}
+        return self.accept_block(block, f, source)
+
+    def check_block_header(self, header):
+        # Whether we have the block already, and whether it has enough work.
+        # Cheap, but another thread adding a block changes what they look at.
+        with self.chain_lock:
+            if self.chain.knows_block(header.generate_hash()):
+                return True, True
+            return False, self.chain.check_header_work(header)
+
+    def new_compact_block(self, data, f, source=None):
+        # A header and short txids; the transactions mostly come from our own
+        # mempool and only the rest is fetched from the peer that sent it
+        try:
+            if len(data["txids"]) > MAX_SHORT_TXIDS_MESSAGE:
+                self.punish_connection(source, 50, "oversized block")
+                return {"type": "error", "data": "Block too large"}
+            header = protocol.unpack(blockchain.BlockHeader, data["header"])
+            short_ids = protocol.unpack_short_txids(data["txids"])
+        except Exception as e:
+            print("[NODE] Failed to parse compact block: ", e)
+            self.punish_connection(source, 10, "unparsable block")
+            return {"type": "error", "data": "Failed to parse block"}
+        block_hash = header.generate_hash()
+        if self.already_seen(gossip.block_item(block_hash), f, "block", source):
+            return {"type": "ok"}
+        known, enough_work = self.check_block_header(header)
+        if known:
+            return {"type": "ok"}
+        if not enough_work:
+            self.punish_connection(source, 50, "block without enough work")
+            return {"type": "error", "data": "Invalid block"}
+
+        by_short_id = {
+            protocol.short_txid(block_hash, transaction.txid): transaction
+            for transaction in self.chain.mempool
+        }
+        transactions = [by_short_id.get(short_id) for short_id in short_ids]
+        missing = [i for i, transaction in enumerate(transactions) if transaction is None]
+        if missing and not self.peer_manager.knows(f):
+            # Never connect out to whatever address a message names
+            return {"type": "error", "data": "Unknown peer, send the full block"}
+        try:
+            if missing:
+                for i, transaction in zip(missing, self.request_block_transactions(f, block_hash, missing)):
+                    transactions[i] = transaction
+            block = blockchain.Block.from_header(header, transactions)
+            if block.generate_hash() != block_hash:
+                # A short id matched the wrong mempool transaction, take them all from the peer
+                if not self.peer_manager.knows(f):
+                    return {"type": "error", "data": "Unknown peer, send the full block"}
+                block.transactions = self.request_block_transactions(f, block_hash, list(range(len(short_ids))))
+        except Exception as e:
+            print(f"[NODE] Failed to get block transactions from {f}: {e}")
+            return {"type": "error", "data": "Failed to rebuild block"}
+        print(f"[NODE] Rebuilt compact block, {len(short_ids) - len(missing)}/{len(short_ids)} transactions from mempool")
+        return self.accept_block(block, f, source)
+
+    def accept_block(self, block, f, source=None):
+        with self.chain_lock:
+            result = self.chain.accept_block(block)
+        if result is None:
             print("[NODE] Invalid block recieved!")
-            conn.send(json.dumps({
-                "type": "error", "data": "Invalid block"
-            }).encode())
-            return
-        self.chain.add_block(block)
-        print("[NODE] Added block to chain!")
-        self.broadcast_block(block, [f,])  # Spread the word about the new block
+            self.punish_connection(source, 50, "invalid block")
+            return {"type": "error", "data": "Invalid block"}
+        if result == "bad_branch":
+            # An earlier block of its branch is invalid, not necessarily
+            # the fault of whoever relayed this one
+            print("[NODE] Block builds on an invalid branch")
+            return {"type": "error", "data": "Block builds on an invalid branch"}
+        if result == "orphan":
+            # We are missing blocks before it, catch up with whoever sent it
+            # if that is a peer we know
+            if self.peer_manager.knows(f):
+                self.broadcaster.submit(self.catch_up, f)
+            return {"type": "ok"}
+        self.seen.add(gossip.block_item(block.generate_hash()))
+        if result in ("side", "known"):
+            print("[NODE] Stored block on a side branch" if result == "side" else "[NODE] Block already known")
+            return {"type": "ok"}
+        print("[NODE] Added block to chain!" if result == "extended" else "[NODE] Switched to a branch with more work!")
+        self.tip_changed()
+        # Spread the word about the new block
+        self.broadcast_block(block, [f] if self.sent_by(f, source) else [], wait=False)
+        return {"type": "ok"}
 
-    def new_transaction(self, conn, data, f):
+    def tip_changed(self):
+        if self.template:
+            self.template.stale = True
+        self.miner.cancel()  # Whatever we were mining now builds on a stale tip
+
+    def catch_up(self, peer):
+        if not self.sync_lock.acquire(blocking=False):
+            return  # Already syncing
+        try:
+            self.sync_chain({peer: self.request_height(peer)})
+        except Exception as e:
+            print(f"[NODE] Failed to sync with {peer}: {e}")
+        finally:
+            self.sync_lock.release()
+
+    def new_transaction(self, data, f, source=None):
+        if not isinstance(data, str) or len(data) > MAX_TRANSACTION_MESSAGE:
+            self.punish_connection(source, 20, "oversized transaction")
+            return {"type": "error", "data": "Transaction too large"}
         try:
-            transaction = blockchain.Transaction.from_dict(data)
+            transaction = protocol.unpack(blockchain.Transaction, data)
         except Exception as e:
             print("[NODE] Failed to parse transaction: ", e)
-            conn.send(json.dumps({
-                "type": "error", "data": "Failed to parse transaction"
-            }).encode())
-            return
-        if not self.chain.validate_transaction(transaction):
+            self.punish_connection(source, 10, "unparsable transaction")
+            return {"type": "error", "data": "Failed to parse transaction"}
+        item = gossip.tx_item(transaction.txid)
+        if transaction in self.chain.mempool:
+            self.seen.add(item)
+        if self.already_seen(item, f, "transaction", source):
+            return {"type": "ok"}
+        # Balance and nonce first, they may just be out of date; a bad
+        # signature is never honest
+        if not self.chain.validate_transaction(transaction, check_signature=False):
+            return {"type": "error", "data": "Invalid transaction"}
+        if not self.chain.verifier.check(transaction):
             print("[NODE] Transaction signature invalid!")
-            conn.send(json.dumps({
-                "type": "error", "data": "Invalid signature"
-            }).encode())
-            return
-        if not transaction in self.chain.mempool:
-            self.broadcast_transaction(transaction, ignore=[f,])
-        self.chain.add_transaction(transaction)
+            self.punish_connection(source, 50, "invalid signature")
+            return {"type": "error", "data": "Invalid signature"}
+        with self.chain_lock:
+            if not self.chain.validate_transaction(transaction):
+                return {"type": "error", "data": "Invalid transaction"}
+            is_new = self.accept_transaction(transaction)
+        if is_new:
+            self.seen.add(item)
+            self.broadcast_transaction(transaction, ignore=[f] if self.sent_by(f, source) else [], wait=False)
+        return {"type": "ok"}
+
+    def new_inventory(self, data, f, source=None):
+        # Announced items: note that f has them and fetch the ones we lack.
+        # Only from peers we know, from is just what the message claims.
+        if not self.peer_manager.knows(f):
+            self.gossip_stats["unknown_announcers"] += 1
+            return {"type": "ok"}
+        wanted = []
+        for kind, identifier in data[:MAX_INVENTORY_PER_REQUEST]:
+            item = (kind, identifier)
+            if self.already_seen(item, f, "announcement", source) or kind != "tx":
+                continue
+            if self.chain.mempool.get(bytes.fromhex(identifier)) is not None:
+                self.seen.add(item)
+                continue
+            with self.gossip_lock:
+                if item in self.in_flight:
+                    # Already being fetched from whoever announced it first
+                    self.gossip_stats["duplicate_announcements"] += 1
+                    continue
+                self.in_flight.add(item)
+            wanted.append(bytes.fromhex(identifier))
+        if wanted:
+            self.broadcaster.submit(self.fetch_announced, f, wanted)
+        return {"type": "ok"}
+
+    def sent_by(self, peer, source):
+        # Whether a message naming peer as its sender came in on a connection
+        # from that peer's host. from is only what the message claims, anyone
+        # could name a peer to keep items from ever being relayed to it.
+        return (source is not None and self.peer_manager.knows(peer)
+                and peers.ban_key(source) == peers.ban_key(peer))
+
+    def already_seen(self, item, peer, kind, source=None):
+        if self.sent_by(peer, source):
+            self.known.add(peer, item)
+        if item in self.seen:
+            self.gossip_stats[f"duplicate_{kind}s"] += 1
+            return True
+        return False
+
+    def fetch_announced(self, peer, txids):
+        try:
+            wanted = set(txids)
+            transactions = [
+                protocol.unpack(blockchain.Transaction, data)
+                for data in self.request_transactions(peer, txids)
+            ]
+            added = self.admit_transactions([tx for tx in transactions if tx.txid in wanted])
+            for transaction in added:
+                self.seen.add(gossip.tx_item(transaction.txid))
+            if added:
+                self.announce([gossip.tx_item(transaction.txid) for transaction in added], [peer], wait=False)
+        except Exception as e:
+            print(f"[NODE] Failed to fetch announced transactions from {peer}: {e}")
+        finally:
+            with self.gossip_lock:
+                self.in_flight.difference_update(gossip.tx_item(txid) for txid in txids)
+
+    def accept_transaction(self, transaction):
+        is_new = self.chain.add_transaction(transaction)
+        if is_new and self.template and not self.template.stale:
+            self.template.add(transaction)  # Picked up by mine() on its next refresh
+        return is_new
+
+    def get_block(self, message_parameter):
+        # By height, or by hash for blocks on the main chain
+        if isinstance(message_parameter, str) and len(message_parameter) == 64:
+            height = self.chain.get_block_height(message_parameter)
+            if height is None:
+                return {"type": "error", "data": "Unknown block"}
+        else:
+            height = int(message_parameter)
+        return {
+            "block": protocol.pack(self.chain.get_block_bytes(height)),
+            "height": height
+        }
+
+    def get_blocks(self, message_parameter):
+        start, count = int(message_parameter[0]), int(message_parameter[1])
+        count = min(count, MAX_BLOCKS_PER_REQUEST)
+        # Full blocks fill a frame long before the count runs out, the
+        # requester asks again for whatever is missing
+        blocks = []
+        size = 0
+        for height in range(start, min(start + count, len(self.chain.chain))):
+            data = protocol.pack(self.chain.get_block_bytes(height))
+            size += len(data)
+            if blocks and size > MAX_BLOCKS_RESPONSE:
+                break
+            blocks.append(data)
+        return {
+            "blocks": blocks
+        }
 
-    def get_block(self, conn, message_parameter):
-        conn.send(json.dumps({
-            "block": self.chain.chain[int(message_parameter)].to_dict()
-        }).encode())
+    def get_headers(self, message_parameter):
+        start, count = int(message_parameter[0]), int(message_parameter[1])
+        count = min(count, MAX_HEADERS_PER_REQUEST)
+        return {
+            "headers": [
+                protocol.pack(self.chain.get_header_bytes(height))
+                for height in range(start, min(start + count, len(self.chain.chain)))
+            ]
+        }
 
-    def get_height(self, conn):
-        conn.send(json.dumps({
+    def get_proof(self, message_parameter):
+        # Inclusion proof of a transaction (by hex txid) in the block at a height
+        height, txid = int(message_parameter[0]), message_parameter[1]
+        block = self.chain.chain[height]
+        for index, transaction in enumerate(block.transactions):
+            if transaction.txid.hex() == txid:
+                return {
+                    "header": protocol.pack(block.header()),
+                    "proof": block.merkle_proof(index)
+                }
+        return {"type": "error", "data": "Transaction not in block"}
+
+    def get_height(self):
+        return {
             "height": len(self.chain.chain)
-        }).encode())
+        }
+
+    def get_mempool(self):
+        print(f"Sending mempool: {len(self.chain.mempool)} transaction(s)")
+        return {
+            "pool": [protocol.pack(transaction) for transaction in list(self.chain.mempool)]
+        }
+
+    def get_mempool_sketch(self, message_parameter):
+        # Bucket summaries below each of the given txid prefixes (hex)
+        prefixes = [bytes.fromhex(prefix) for prefix in message_parameter[:MAX_SKETCHES_PER_REQUEST]]
+        if any(len(prefix) >= 32 for prefix in prefixes):
+            return {"type": "error", "data": "Prefix too long"}
+        return {
+            "sketches": [protocol.pack_sketch(self.chain.mempool.sketch(prefix)) for prefix in prefixes]
+        }
+
+    def get_inventory(self, message_parameter):
+        txids = []
+        for prefix in message_parameter[:MAX_SKETCHES_PER_REQUEST]:
+            txids.extend(self.chain.mempool.inventory(bytes.fromhex(prefix)))
+        return {
+            "txids": [txid.hex() for txid in txids[:MAX_INVENTORY_PER_REQUEST]]
+        }
 
-    def get_mempool(self, conn):
-        print(f"Sending mempool: {self.chain.mempool}")
-        conn.send(json.dumps({
-            "pool": [transaction.to_external_dict() for transaction in list(self.chain.mempool)]
-        }).encode())
+    def get_transactions(self, message_parameter):
+        found = [
+            self.chain.mempool.get(bytes.fromhex(txid))
+            for txid in message_parameter[:MAX_TRANSACTIONS_PER_REQUEST]
+        ]
+        return {
+            "transactions": [protocol.pack(transaction) for transaction in found if transaction is not None]
+        }
 
-    def get_peers(self, conn):
-        conn.send(json.dumps({
-            "peers": list(self.peers)
-        }).encode())
+    def get_block_transactions(self, message_parameter):
+        block_hash, indexes = message_parameter[0], message_parameter[1]
+        with self.relay_lock:
+            block = self.relayed.get(block_hash)
+        if block is None:
+            return {"type": "error", "data": "Unknown block"}
+        return {
+            "transactions": [protocol.pack(block.transactions[int(i)]) for i in indexes]
+        }
 
-    def get_ping(self, conn):
-        conn.send(json.dumps({
+    def get_transaction(self, message_parameter):
+        # A transaction by txid (hex), with where it was mined if it was
+        txid = bytes.fromhex(message_parameter)
+        found = self.chain.get_transaction(txid)
+        if found is None:
+            transaction = self.chain.mempool.get(txid)
+            if transaction is None:
+                return {"type": "error", "data": "Unknown transaction"}
+            found = (transaction, None, None)
+        transaction, height, position = found
+        return {
+            "transaction": protocol.pack(transaction),
+            "height": height,
+            "position": position
+        }
+
+    def get_address_history(self, message_parameter):
+        address, start = message_parameter[0], int(message_parameter[1])
+        return {
+            "history": [
+                [txid.hex(), height, position]
+                for txid, height, position in self.chain.get_address_history(address, start, MAX_HISTORY_PER_REQUEST)
+            ]
+        }
+
+    def get_peers(self):
+        return {
+            "peers": self.peer_manager.sample(MAX_PEERS_PER_REQUEST)
+        }
+
+    def get_ping(self):
+        return {
             "ping": True
-        }).encode())
+        }
+
+    def mine(self, template, refresh_interval=2):
+        # Mine the template's block, moving on to its latest version whenever
+        # transactions were added to it. Returns None if the tip changed.
+        block = None
+        job_id = None
+        while not template.stale:
+            if template.block is not block:
+                block = template.block
+                job_id = self.miner.submit(block, template.target)
+            work = self.miner.wait(job_id, timeout=refresh_interval)
+            if work is not None:
+                block.work = work
+                return block
+            if not self.miner.is_current(job_id) and template.block is block:
+                return None  # Cancelled
+        return None
 
     # !!CLIENT CODE!!
-    def broadcast_block(self, block, ignore=[]):
-        print(f"[NODE] Broadcasting Block to {len(self.peers)} peers")
+    def request(self, peer, message, timeout=10):
+        # Send over the pooled connection to peer, dropping it if it broke
+        try:
+            response = self.connections.get(peer).request(message, timeout)
+        except (OSError, TimeoutError):
+            self.connections.discard(peer)
+            self.peer_manager.failed(peer)
+            raise
+        self.peer_manager.succeeded(peer)
+        if response.get("type") == "error":
+            raise Exception(f"Peer {peer} replied with error: {response.get('data')}")
+        return response
+
+    def deliver(self, peer, message, timeout=None):
+        # Send one message and wait for the peer to acknowledge it
+        start = time.time()
+        try:
+            response = self.connections.get(peer).request(message, timeout or self.send_timeout)
+        except Exception as e:
+            self.connections.discard(peer)
+            self.known.forget(peer)  # Whatever we sent may not have arrived
+            self.peer_manager.failed(peer)
+            return {"delivered": False, "latency": time.time() - start, "error": str(e) or type(e).__name__}
+        self.peer_manager.succeeded(peer)
+        error = response.get("data") if response.get("type") == "error" else None
+        return {"delivered": True, "latency": time.time() - start, "error": error}
+
+    def fan_out(self, message, ignore=[], timeout=None, item=None):
+        # With an item, peers already known to have it are skipped. The best
+        # peers are queued first so they hear about it first.
+        futures = {}
+        for peer in self.peer_manager.ranked():
+            if peer in ignore:
+                continue
+            if item is not None and not self.known.add(peer, item):
+                self.gossip_stats["suppressed_sends"] += 1
+                continue
+            futures[peer] = self.broadcaster.submit(self.deliver, peer, message, timeout)
+        return futures
+
+    def announce(self, items, ignore=[], wait=True):
+        # Tell every peer about the items it is not known to have yet
         origin = (self.host, self.port)
-        for index, peer in enumerate(list(self.peers)):
+        futures = {}
+        for peer in self.peer_manager.ranked():
             if peer in ignore:
                 continue
-            try:
-                print(f"[NODE] Sending block to peer {index + 1}/{len(self.peers)}")
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect(peer)
-                s.send(json.dumps({
-                    "type": "new_block", "from": origin, "data": block.to_json()
-                }).encode())
-                s.close()
-            except Exception as e:
-                print(f"[NODE] Failed to block send to {peer} with error {e}")
+            fresh = [list(item) for item in items if self.known.add(peer, item)]
+            self.gossip_stats["suppressed_sends"] += len(items) - len(fresh)
+            if fresh:
+                futures[peer] = self.broadcaster.submit(self.deliver, peer, {
+                    "type": "new_inventory", "from": origin, "data": fresh
+                })
+        if wait:
+            return self.summarize(futures, "announcement")
+
+    def summarize(self, futures, what):
+        results = {peer: future.result() for peer, future in futures.items()}
+        for peer, result in results.items():
+            if result["delivered"]:
+                print(f"[NODE] Sent {what} to {peer} in {result['latency'] * 1000:.0f}ms"
+                      + (f" (rejected: {result['error']})" if result["error"] else ""))
+            else:
+                print(f"[NODE] Failed to send {what} to {peer} with error {result['error']}")
+        delivered = sum(result["delivered"] for result in results.values())
+        print(f"[NODE] Delivered {what} to {delivered}/{len(results)} peers")
+        return results
+
+    def broadcast_block(self, block, ignore=[], wait=True, compact=True):
+        print(f"[NODE] Broadcasting Block to {len(self.peers)} peers")
+        origin = (self.host, self.port)
+        block_hash = block.generate_hash()
+        self.seen.add(gossip.block_item(block_hash))
+        if compact:
+            with self.relay_lock:
+                # Peers fetch the transactions they lack from here
+                self.relayed[block_hash] = block
+                while len(self.relayed) > RELAY_CACHE_SIZE:
+                    self.relayed.popitem(last=False)
+            message = {
+                "type": "new_compact_block", "from": origin, "data": {
+                    "header": protocol.pack(block.header()),
+                    "txids": protocol.pack_short_txids(
+                            [protocol.short_txid(block_hash, tx.txid) for tx in block.transactions]
+                    )
+                }
+            }
+        else:
+            message = {
+                "type": "new_block", "from": origin, "data": protocol.pack(block)
+            }
+        futures = self.fan_out(message, ignore, item=gossip.block_item(block_hash))
+        if wait:
+            return self.summarize(futures, "block")
 
-    def broadcast_transaction(self, transaction, ignore=[]):
+    def broadcast_transaction(self, transaction, ignore=[], wait=True, announce=True):
+        # Announced by txid by default, peers fetch it if they don't have it
         print(f"[NODE] Broadcasting Transaction to {len(self.peers)} peers")
+        item = gossip.tx_item(transaction.txid)
+        self.seen.add(item)
+        if announce:
+            return self.announce([item], ignore, wait)
         origin = (self.host, self.port)
-        print(f"origin: {origin}")
-        for index, peer in enumerate(list(self.peers)):
-            if list(peer) in ignore:
-                continue
-            try:
-                print(f"[NODE] Sending transaction to peer {index + 1}/{len(self.peers)}")
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect(peer)
-                s.send(json.dumps({
-                    "type": "new_transaction", "from": origin, "data": transaction.to_external_dict()
-                }).encode())
-                s.close()
-            except Exception as e:
-                print(f"[NODE] Failed to send transaction to {peer} with error {e}")
+        futures = self.fan_out({
+            "type": "new_transaction", "from": origin, "data": protocol.pack(transaction)
+        }, ignore, item=item)
+        if wait:
+            return self.summarize(futures, "transaction")
 
     def request_height(self, peer):
         # Connect to peer and reqeuest height
         print(f"[NODE] Requesting height from {peer}")
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(peer)
-        s.send(json.dumps({
+        return self.request(peer, {
             "type": "get_height"
-        }).encode())
-        height = json.loads(s.recv(4096).decode())["height"]
-        s.close()
-        return height
+        })["height"]
 
     def request_mempool(self, peer):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(peer)
-        s.send(json.dumps({
+        return self.request(peer, {
             "type": "get_mempool"
-        }).encode())
-        pool = json.loads(s.recv(4096).decode())["pool"]
-        s.close()
-        return pool
+        })["pool"]
+
+    def request_sketches(self, peer, prefixes):
+        return [
+            protocol.unpack_sketch(sketch)
+            for sketch in self.request(peer, {
+                "type": "get_mempool_sketch", "parameter": [prefix.hex() for prefix in prefixes]
+            })["sketches"]
+        ]
+
+    def request_inventory(self, peer, prefixes):
+        return [
+            bytes.fromhex(txid)
+            for txid in self.request(peer, {
+                "type": "get_inventory", "parameter": [prefix.hex() for prefix in prefixes]
+            })["txids"]
+        ]
+
+    def request_transactions(self, peer, txids):
+        return self.request(peer, {
+            "type": "get_transactions", "parameter": [txid.hex() for txid in txids]
+        }, timeout=30)["transactions"]
+
+    def missing_transactions(self, peer):
+        # Txids in peer's mempool that are not in ours. Walks down the txid
+        # prefix tree a level per round trip, only into buckets whose
+        # summaries differ, so the traffic follows the size of the difference.
+        mempool = self.chain.mempool
+        missing = []
+        prefixes = [b""]
+        while prefixes:
+            split, listed = [], []
+            for i in range(0, len(prefixes), MAX_SKETCHES_PER_REQUEST):
+                batch = prefixes[i:i + MAX_SKETCHES_PER_REQUEST]
+                for prefix, remote in zip(batch, self.request_sketches(peer, batch)):
+                    local = mempool.sketch(prefix)
+                    for byte, summary in enumerate(remote[:256]):
+                        if not summary[0] or summary == local[byte]:
+                            continue
+                        child = prefix + bytes((byte,))
+                        if summary[0] <= RECONCILE_THRESHOLD or len(child) == 31:
+                            listed.append(child)
+                        else:
+                            split.append(child)
+            per_request = MAX_INVENTORY_PER_REQUEST // RECONCILE_THRESHOLD
+            for i in range(0, len(listed), per_request):
+                for txid in self.request_inventory(peer, listed[i:i + per_request]):
+                    if mempool.get(txid) is None:
+                        missing.append(txid)
+            prefixes = split
+        return missing
+
+    def admit_transactions(self, transactions):
+        # Drop what fails the cheap checks, then check the rest's signatures
+        # at once, across processes, and only fall back to one by one if
+        # some of them are bad
+        transactions = [
+            transaction for transaction in transactions
+            if self.chain.validate_transaction(transaction, check_signature=False)
+        ]
+        checked = self.chain.verifier.verify(transactions)
+        added = []
+        with self.chain_lock:
+            for transaction in transactions:
+                if (self.chain.validate_transaction(transaction, check_signature=not checked)
+                        and self.accept_transaction(transaction)):
+                    added.append(transaction)
+        return added
+
+    def sync_mempool(self, peer):
+        missing = self.missing_transactions(peer)
+        added = 0
+        for i in range(0, len(missing), MAX_TRANSACTIONS_PER_REQUEST):
+            wanted = set(missing[i:i + MAX_TRANSACTIONS_PER_REQUEST])
+            transactions = [
+                protocol.unpack(blockchain.Transaction, data)
+                for data in self.request_transactions(peer, missing[i:i + MAX_TRANSACTIONS_PER_REQUEST])
+            ]
+            added += len(self.admit_transactions([tx for tx in transactions if tx.txid in wanted]))
+        return len(missing), added
+
+    def request_block_transactions(self, peer, block_hash, indexes):
+        transactions = self.request(peer, {
+            "type": "get_block_transactions", "parameter": [block_hash, indexes]
+        }, timeout=30)["transactions"]
+        if len(transactions) != len(indexes):
+            raise Exception(f"Expected {len(indexes)} transactions, got {len(transactions)}")
+        return [protocol.unpack(blockchain.Transaction, data) for data in transactions]
+
+    def request_transaction(self, peer, txid):
+        response = self.request(peer, {
+            "type": "get_transaction", "parameter": txid.hex()
+        })
+        return protocol.unpack(blockchain.Transaction, response["transaction"]), response["height"], response["position"]
+
+    def request_address_history(self, peer, address):
+        history = []
+        while True:
+            batch = self.request(peer, {
+                "type": "get_address_history", "parameter": [address, len(history)]
+            })["history"]
+            history.extend((bytes.fromhex(txid), height, position) for txid, height, position in batch)
+            if len(batch) < MAX_HISTORY_PER_REQUEST:
+                return history
 
     def request_peers(self, peer):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(peer)
-        s.send(json.dumps({
+        return self.request(peer, {
             "type": "get_peers"
-        }).encode())
-        peers = json.loads(s.recv(4096).decode())["peers"]
-        s.close()
-        return peers
+        })["peers"]
+
+    def discover_peers(self, peer):
+        # Add peer's addresses to our address table, returns how many were new
+        addresses = [
+            address for address in self.request_peers(peer)[:MAX_PEERS_PER_REQUEST]
+            if tuple(address) != (self.host, self.port)
+        ]
+        return self.peer_manager.add_addresses(addresses)
+
+    def ping(self, peer):
+        start = time.time()
+        try:
+            self.connections.get(peer).request({"type": "get_ping"}, self.connect_timeout)
+        except Exception:
+            self.connections.discard(peer)
+            self.peer_manager.failed(peer)
+            return False
+        self.peer_manager.succeeded(peer, time.time() - start)
+        return True
+
+    def punish_connection(self, address, score, reason):
+        # The peer that sent a message, by the connection it came in on;
+        # the from field of a message could name anyone
+        if address is not None:
+            self.peer_manager.connection_misbehaved(address, score, reason)
+
+    def punish(self, peer, score, reason):
+        if peer and self.peer_manager.misbehaved(peer, score, reason):
+            print(f"[NODE] Disconnecting from {peer}")
+            self.connections.discard(peer)
+            self.known.forget(peer)
+
+    def maintain_peers(self, interval=PING_INTERVAL):
+        while True:
+            try:
+                self.check_peers()
+            except Exception as e:
+                print("[NODE] ERROR: ", e)
+            time.sleep(interval)
+
+    def check_peers(self):
+        # Ping the peers we use, which also drops the ones that stopped
+        # answering, then top up to the target number of connections from
+        # the address table and let go of the worst peers beyond it
+        manager = self.peer_manager
+        for future in [self.broadcaster.submit(self.ping, peer) for peer in manager.ranked()]:
+            future.result()
+        missing = manager.target_outbound - len(self.peers)
+        if missing > 0:
+            if len(manager.addresses) < missing and self.peers:
+                try:
+                    self.discover_peers(random.choice(manager.ranked()))
+                except Exception as e:
+                    print(f"[NODE] Failed to get peers: {e}")
+            candidates = [peer for peer in manager.candidates(missing) if peer != (self.host, self.port)]
+            pings = {peer: self.broadcaster.submit(self.ping, peer) for peer in candidates}
+            for peer, future in pings.items():
+                if future.result() and manager.add_peer(peer):
+                    print(f"[NODE] Connected to peer {peer}")
+        for peer in manager.surplus():
+            print(f"[NODE] Letting go of peer {peer}")
+            manager.remove_peer(peer)
+            self.connections.discard(peer)
 
     def request_block(self, peer, block_ind):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(peer)
-        s.send(json.dumps({
+        return self.request(peer, {
             "type": "get_block", "parameter": block_ind
-        }).encode())
-        block = json.loads(s.recv(4096).decode())["block"]
-        s.close()
-        return block
+        })["block"]
+
+    def request_blocks(self, peer, start, count):
+        return self.request(peer, {
+            "type": "get_blocks", "parameter": [start, count]
+        }, timeout=30)["blocks"]
+
+    def download_blocks(self, peer_heights, start, end, batch_size=100, window=8):
+        # Yields (peer, block dicts) for heights start..end-1 in order, with up
+        # to `window` batches in flight spread over every peer that has them.
+        # Peers that fail a request are dropped from peer_heights.
+        batches = [(height, min(batch_size, end - height)) for height in range(start, end, batch_size)]
+        pending = {}
+
+        def submit(i):
+            height, count = batches[i]
+            # Spread over the best peers only, a slow one would hold up every batch after its own
+            candidates = self.peer_manager.ranked(
+                    peer for peer, h in peer_heights.items() if h >= height + count
+            )[:window]
+            if not candidates:
+                raise Exception(f"No peer can serve blocks {height}-{height + count - 1}")
+            peer = candidates[i % len(candidates)]
+            pending[i] = (peer, self.broadcaster.submit(self.request_blocks, peer, height, count))
+
+        for i in range(min(window, len(batches))):
+            submit(i)
+        for i in range(len(batches)):
+            while True:
+                peer, future = pending.pop(i)
+                try:
+                    blocks = future.result()
+                    height, count = batches[i]
+                    # A reply stops short when the blocks fill a frame
+                    while len(blocks) < count:
+                        more = self.request_blocks(peer, height + len(blocks), count - len(blocks))
+                        if not more:
+                            break
+                        blocks += more
+                    if len(blocks) != count:
+                        raise Exception(f"Expected {count} blocks, got {len(blocks)}")
+                    break
+                except Exception as e:
+                    print(f"[NODE] Failed to get blocks from {peer}: {e}")
+                    peer_heights.pop(peer, None)
+                    submit(i)
+            if i + window < len(batches):
+                submit(i + window)
+            yield peer, blocks
+
+    def request_headers(self, peer, start, count):
+        return self.request(peer, {
+            "type": "get_headers", "parameter": [start, count]
+        }, timeout=30)["headers"]
+
+    def download_headers(self, peer, start, end):
+        headers = []
+        while start + len(headers) < end:
+            height = start + len(headers)
+            batch = self.request_headers(peer, height, min(MAX_HEADERS_PER_REQUEST, end - height))
+            if not batch:
+                raise Exception(f"Peer {peer} sent no headers from height {height}")
+            headers.extend(protocol.unpack(blockchain.BlockHeader, data) for data in batch)
+        return headers
+
+    def apply_blocks(self, encoded_blocks, expected_hashes=None):
+        # True once applied, False if the blocks are invalid, None if they
+        # can't be used right now (e.g. our chain moved on underneath them)
+        try:
+            blocks = [protocol.unpack(blockchain.Block, data) for data in encoded_blocks]
+        except Exception as e:
+            print("[NODE] Failed to parse block: ", e)
+            return False
+        # Bodies have to match the header chain we already checked
+        if expected_hashes is not None:
+            for block, expected in zip(blocks, expected_hashes):
+                if block.generate_hash() != expected:
+                    print("[NODE] Block does not match its header")
+                    return False
+        with self.chain_lock:
+            # Check every signature in the batch at once, across processes
+            if not self.chain.verifier.verify([tx for block in blocks for tx in block.transactions]):
+                print("[NODE] Invalid transaction signature in batch")
+                return False
+            tip = self.chain.get_last_hash()
+            for block in blocks:
+                result = self.chain.accept_block(block, check_signatures=False)
+                if result is None:
+                    return False
+                if result in ("orphan", "bad_branch"):
+                    return None
+        if self.chain.get_last_hash() != tip:
+            self.tip_changed()
+        return True
+
+    def download_branch(self, peer, height):
+        # The peer's headers up to height that are not on our chain, and the
+        # height the first of them is at. Below our tip we start a little
+        # down and, while the first header doesn't build on our chain, step
+        # further down, doubling the overlap, as deep as we could still
+        # reorganize. Above it every batch is checked as it arrives, so a
+        # peer claiming a huge height can't have us hold on to junk; the
+        # headers are None once one fails.
+        tip = len(self.chain.chain)
+        floor = max(1, tip - self.chain.state.max_undo)
+        start = max(floor, tip - SYNC_OVERLAP)
+        headers = self.download_headers(peer, start, min(height, tip))
+        overlap = SYNC_OVERLAP
+        while start > floor and headers and headers[0].prev_hash not in self.chain.recent:
+            overlap *= 2
+            lower = max(floor, tip - overlap)
+            headers = self.download_headers(peer, lower, start) + headers
+            start = lower
+
+        fork = 0
+        while fork < len(headers) and headers[fork].generate_hash() in self.chain.recent:
+            fork += 1
+        start, headers = start + fork, headers[fork:]
+        if headers and self.chain.locate_block(headers[0].prev_hash) is None:
+            # Honest, just forked off deeper than we can reorganize
+            raise Exception("its chain forks off too deep to follow")
+
+        checked = 0
+        while True:
+            if checked < len(headers):
+                if not self.chain.validate_headers(headers, checked):
+                    return start, None
+                checked = len(headers)
+            if start + len(headers) >= height:
+                return start, headers
+            headers += self.download_headers(
+                    peer, start + len(headers), min(start + len(headers) + MAX_HEADERS_PER_REQUEST, height)
+            )
+
+    def sync_headers(self, peer_heights):
+        # Fetch every taller peer's headers from where it forks off our chain,
+        # and keep the branch with the most work. Returns the height that
+        # branch starts at, its block hashes and how far along it each peer
+        # agrees.
+        tip = len(self.chain.chain)
+        futures = {
+            peer: self.broadcaster.submit(self.download_branch, peer, height)
+            for peer, height in peer_heights.items() if height > max(1, tip - SYNC_OVERLAP)
+        }
+        branches = {}
+        best_peer, best_work = None, self.chain.state.work
+        for peer, future in futures.items():
+            try:
+                start, headers = future.result()
+            except Exception as e:
+                print(f"[NODE] Failed to get headers from {peer}: {e}")
+                continue
+            if headers is None:
+                print(f"[NODE] Invalid header chain from peer {peer}")
+                self.punish(peer, peers.MAX_MISBEHAVIOR, "invalid header chain")
+                continue
+            if not headers:
+                continue  # Nothing we don't have
+            branches[peer] = (start, [header.generate_hash() for header in headers])
+            work = self.chain.branch_work(headers)
+            if work > best_work:
+                best_peer, best_work = peer, work
+        if best_peer is None:
+            return tip, [], {}
+
+        # Only peers forking off at the same height can be on the same branch
+        fork, best = branches[best_peer]
+        agree = {}
+        for peer, (start, hashes) in branches.items():
+            if start != fork:
+                continue
+            count = 0
+            for block_hash, expected in zip(hashes, best):
+                if block_hash != expected:
+                    break
+                count += 1
+            if count:
+                agree[peer] = fork + count
+        return fork, best, agree
+
+    def sync_chain(self, peer_heights, batch_size=100):
+        fork, best, candidates = self.sync_headers(peer_heights)
+        if not best:
+            return len(self.chain.chain)
+        print(f"[NODE] Best branch forks off at height {fork} and reaches height {fork + len(best)}")
+        height = fork
+        while candidates:
+            target = max(candidates.values())
+            if target <= height:
+                break
+            print(f"[NODE] Downloading blocks {height}-{target - 1} from {len(candidates)} peer(s)")
+            bad_peer = applied = None
+            try:
+                for peer, blocks in self.download_blocks(candidates, height, target, batch_size):
+                    applied = self.apply_blocks(blocks, best[height - fork:height - fork + len(blocks)])
+                    if not applied:
+                        bad_peer = peer
+                        break
+                    height += len(blocks)
+            except Exception as e:
+                print(f"[NODE] Sync failed: {e}")
+                break
+            if bad_peer is None:
+                break
+            candidates.pop(bad_peer, None)
+            if applied is None:
+                print(f"[NODE] Can't use the chain from peer {bad_peer} right now")
+            else:
+                print(f"[NODE] Invalid chain from peer {bad_peer}")
+                self.punish(bad_peer, peers.MAX_MISBEHAVIOR, "invalid chain")
+        return len(self.chain.chain)
+
+    def request_proof(self, peer, height, transaction):
+        # Light client check: is transaction in the block at height, according
+        # to a header we can verify for proof of work ourselves
+        response = self.request(peer, {
+            "type": "get_proof", "parameter": [height, transaction.txid.hex()]
+        })
+        header = protocol.unpack(blockchain.BlockHeader, response["header"])
+        if not blockchain.verify_merkle_proof(transaction.txid, response["proof"], header.merkle_root):
+            return None
+        return header
@@ -0,0 +1,259 @@
+import ipaddress
+import random
+import threading
+import time
+from collections import OrderedDict
+
+RTT_WEIGHT = 0.2  # of the newest sample in the smoothed round trip time
+FAILURE_WEIGHT = 0.1  # of the newest request in the smoothed failure rate
+DEFAULT_RTT = 1.0  # seconds, assumed for peers we have not measured yet
+MAX_FAILURES = 3  # in a row before a peer is dropped back to the address table
+MAX_MISBEHAVIOR = 100  # score at which a peer is dropped and never used again, and its host banned
+MISBEHAVIOR_DECAY = 1 / 60  # points of an inbound connection's score forgiven per second
+BAN_DURATION = 24 * 60 * 60
+MAX_BANS = 10000
+
+
+def ban_key(address):
+    # Remote peers are banned and rate limited by host, local ones (several
+    # nodes on one machine) only by their own address or connection
+    try:
+        local = ipaddress.ip_address(address[0]).is_loopback
+    except ValueError:
+        local = address[0] == "localhost"
+    return tuple(address) if local else address[0]
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    # A token bucket per peer and message type. rates maps message types to
+    # (per second, burst), every other type shares the default bucket. When
+    # full the least recently used buckets go first, a peer coming back just
+    # starts over with a full one.
+    def __init__(self, rates, default, max_buckets=10000):
+        self.rates = rates
+        self.default = default
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, peer, message_type):
+        if message_type not in self.rates:
+            message_type = None
+        key = (peer, message_type)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(*self.rates.get(message_type, self.default))
+                while len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            return bucket.take()
+
+
+class PeerStats:
+    def __init__(self):
+        self.rtt = None
+        self.failure_rate = 0.0
+        self.failures = 0  # in a row
+        self.misbehavior = 0
+        self.last_seen = 0
+
+    def cost(self):
+        # Expected seconds per successful request, lower is better
+        rtt = DEFAULT_RTT if self.rtt is None else self.rtt
+        return rtt / max(1 - self.failure_rate, 0.01) * (1 + self.misbehavior / 10)
+
+
+class PeerManager:
+    # Keeps track of how every peer we talked to behaves and which of them
+    # we use. Peers we heard about but never tried wait in a bounded address
+    # table; both tables forget the oldest entries first when full.
+    def __init__(self, target_outbound=8, max_addresses=1000, max_tracked=1000):
+        self.target_outbound = target_outbound
+        self.max_addresses = max_addresses
+        self.max_tracked = max_tracked
+        self.outbound = set()  # peers we send to and download from
+        self.stats = OrderedDict()  # peer -> PeerStats, least recently seen first
+        self.addresses = OrderedDict()  # untried peer -> time we heard of it
+        self.scores = OrderedDict()  # ban_key of inbound connections -> (misbehavior score, time of last update)
+        self.bans = OrderedDict()  # ban_key -> time the ban ends
+        self.lock = threading.RLock()
+
+    def _stats(self, peer):
+        stats = self.stats.get(peer)
+        if stats is None:
+            stats = self.stats[peer] = PeerStats()
+            self.addresses.pop(peer, None)
+            for old in list(self.stats):
+                if len(self.stats) <= self.max_tracked:
+                    break
+                if old not in self.outbound:
+                    del self.stats[old]
+        return stats
+
+    def add_peer(self, peer):
+        # Use peer right away, e.g. one of our configured nodes
+        peer = tuple(peer)
+        with self.lock:
+            if self.banned(peer):
+                return False
+            self._stats(peer)
+            self.outbound.add(peer)
+            return True
+
+    def knows(self, peer):
+        # A peer we connected to ourselves, as opposed to any address a
+        # message claims to come from
+        with self.lock:
+            return (peer in self.outbound or peer in self.stats) and not self.banned(peer)
+
+    def remove_peer(self, peer):
+        with self.lock:
+            self.outbound.discard(tuple(peer))
+
+    def add_addresses(self, addresses):
+        # Addresses learned from other peers, returns how many were new
+        added = 0
+        with self.lock:
+            for peer in addresses:
+                peer = (str(peer[0]), int(peer[1]))
+                if peer in self.addresses or peer in self.stats or self.is_banned(peer):
+                    continue
+                self.addresses[peer] = time.time()
+                added += 1
+            while len(self.addresses) > self.max_addresses:
+                self.addresses.popitem(last=False)
+        return added
+
+    def succeeded(self, peer, rtt=None):
+        # rtt only from pings, other requests also measure the work they asked for
+        with self.lock:
+            stats = self._stats(peer)
+            if rtt is not None:
+                stats.rtt = rtt if stats.rtt is None else (1 - RTT_WEIGHT) * stats.rtt + RTT_WEIGHT * rtt
+            stats.failure_rate *= 1 - FAILURE_WEIGHT
+            stats.failures = 0
+            stats.last_seen = time.time()
+            self.stats.move_to_end(peer)
+
+    def failed(self, peer):
+        with self.lock:
+            stats = self._stats(peer)
+            stats.failure_rate = (1 - FAILURE_WEIGHT) * stats.failure_rate + FAILURE_WEIGHT
+            stats.failures += 1
+            if stats.failures >= MAX_FAILURES and peer in self.outbound:
+                print(f"[NODE] Dropping unreachable peer {peer}")
+                self.outbound.discard(peer)
+
+    def misbehaved(self, peer, score, reason):
+        # Returns True once peer is dropped for good
+        with self.lock:
+            stats = self._stats(peer)
+            stats.misbehavior += score
+            print(f"[NODE] Peer {peer} misbehaved ({reason}), score {stats.misbehavior}")
+            if stats.misbehavior < MAX_MISBEHAVIOR:
+                return False
+            self.ban(peer)
+            return True
+
+    def connection_misbehaved(self, address, score, reason):
+        # For inbound connections, whose address says nothing about where
+        # they listen. Returns True once the connection's host is banned.
+        # The score wears off over time, so an honest but busy peer that
+        # now and then hits a rate limit is never banned for it
+        key = ban_key(address)
+        now = time.time()
+        with self.lock:
+            total, updated = self.scores.pop(key, (0, now))
+            total = max(0, total - (now - updated) * MISBEHAVIOR_DECAY) + score
+            self.scores[key] = (total, now)
+            while len(self.scores) > self.max_tracked:
+                self.scores.popitem(last=False)
+        print(f"[NODE] Connection from {address} misbehaved ({reason}), score {total:.0f}")
+        if total < MAX_MISBEHAVIOR:
+            return False
+        self.ban(address)
+        return True
+
+    def ban(self, address, duration=BAN_DURATION):
+        key = ban_key(address)
+        print(f"[NODE] Banning {key} for {duration}s")
+        with self.lock:
+            self.bans.pop(key, None)
+            self.bans[key] = time.time() + duration
+            while len(self.bans) > MAX_BANS:
+                self.bans.popitem(last=False)
+            self.scores.pop(key, None)
+            for peer in [peer for peer in self.outbound if ban_key(peer) == key]:
+                self.outbound.discard(peer)
+
+    def is_banned(self, address):
+        key = ban_key(address)
+        with self.lock:
+            until = self.bans.get(key)
+            if until is not None and until < time.time():
+                del self.bans[key]
+                until = None
+        return until is not None
+
+    def banned(self, peer):
+        # Never to be used again, or banned for now
+        stats = self.stats.get(peer)
+        return (stats is not None and stats.misbehavior >= MAX_MISBEHAVIOR) or self.is_banned(peer)
+
+    def cost(self, peer):
+        stats = self.stats.get(peer)
+        return stats.cost() if stats is not None else PeerStats().cost()
+
+    def ranked(self, peers=None):
+        # Best first: fast, reliable and well behaved
+        with self.lock:
+            peers = list(self.outbound if peers is None else peers)
+            return sorted(peers, key=self.cost)
+
+    def candidates(self, count):
+        # Peers to try connecting to: the best ones we used before, then
+        # addresses we heard of but never tried, in random order, and only
+        # then the ones that stopped answering
+        with self.lock:
+            tried = self.ranked(
+                peer for peer, stats in self.stats.items()
+                if peer not in self.outbound and not self.banned(peer)
+            )
+            untried = [peer for peer in self.addresses if not self.is_banned(peer)]
+            working = [peer for peer in tried if not self.stats[peer].failures]
+            failing = [peer for peer in tried if self.stats[peer].failures]
+        random.shuffle(untried)
+        return (working + untried + failing)[:count]
+
+    def surplus(self):
+        # Our worst peers beyond the target number of connections
+        with self.lock:
+            return self.ranked()[self.target_outbound:]
+
+    def sample(self, count):
+        # Addresses to share with a peer that asks for them
+        with self.lock:
+            peers = list(self.outbound) + [
+                peer for peer, stats in self.stats.items()
+                if peer not in self.outbound and stats.last_seen and stats.misbehavior < MAX_MISBEHAVIOR
+            ]
+        return peers[:count]
@@ -0,0 +1,202 @@
+import base64
+import hashlib
+import itertools
+import json
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+
+# Every message on the wire is a 4 byte big-endian length followed by that
+# many bytes of JSON. Requests carry an "id" that the response echoes back, so
+# many requests can be in flight on one connection. Blocks and transactions
+# inside a message are base64 strings of their compact binary encoding.
+HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 32 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack(obj):
+    # Blocks, headers and transactions travel in their binary encoding
+    return base64.b64encode(obj if isinstance(obj, bytes) else obj.to_bytes()).decode()
+
+
+def unpack(cls, data):
+    return cls.from_bytes(base64.b64decode(data))
+
+
+SKETCH_ENTRY = struct.Struct(">IQ")
+
+
+def pack_sketch(sketch):
+    return base64.b64encode(b"".join(SKETCH_ENTRY.pack(count, total) for count, total in sketch)).decode()
+
+
+def unpack_sketch(data):
+    return list(SKETCH_ENTRY.iter_unpack(base64.b64decode(data)))
+
+
+# Compact blocks name their transactions by short ids, salted with the block
+# hash so nobody can craft transactions that collide in every block
+SHORT_TXID_SIZE = 6
+
+
+def short_txid(block_hash, txid):
+    return hashlib.sha256(bytes.fromhex(block_hash) + txid).digest()[:SHORT_TXID_SIZE]
+
+
+def pack_short_txids(short_ids):
+    return base64.b64encode(b"".join(short_ids)).decode()
+
+
+def unpack_short_txids(data):
+    raw = base64.b64decode(data)
+    if len(raw) % SHORT_TXID_SIZE:
+        raise ProtocolError("Truncated short txids")
+    return [raw[i:i + SHORT_TXID_SIZE] for i in range(0, len(raw), SHORT_TXID_SIZE)]
+
+
+def encode_frame(message):
+    payload = json.dumps(message).encode()
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes is too large")
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode_frame_header(header):
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes is too large")
+    return length
+
+
+def recv_exact(sock, n, retry_timeouts=False):
+    buf = bytearray()
+    while len(buf) < n:
+        try:
+            chunk = sock.recv(min(n - len(buf), 1 << 20))
+        except socket.timeout:
+            # The timeout is there for sends, keep what we have and wait on
+            if retry_timeouts:
+                continue
+            raise
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+
+def read_frame(sock, retry_timeouts=False):
+    # Returns None when the other side closed the connection between frames
+    header = recv_exact(sock, HEADER.size, retry_timeouts)
+    if header is None:
+        return None
+    length = decode_frame_header(header)
+    payload = recv_exact(sock, length, retry_timeouts)
+    if payload is None:
+        raise ProtocolError("Connection closed mid-frame")
+    return json.loads(payload)
+
+
+def send_frame(sock, message):
+    sock.sendall(encode_frame(message))
+
+
+class PeerConnection:
+    def __init__(self, peer, timeout=10, send_timeout=10):
+        self.peer = peer
+        self.sock = socket.create_connection(peer, timeout=timeout)
+        # A send that stalls this long means a dead peer; the reader thread
+        # just retries its recv when the timeout fires
+        self.sock.settimeout(send_timeout)
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.send_lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self._read_responses, daemon=True).start()
+
+    def _read_responses(self):
+        try:
+            while True:
+                message = read_frame(self.sock, retry_timeouts=True)
+                if message is None or self.closed:
+                    break
+                future = self.pending.pop(message.get("id"), None)
+                if future is not None:
+                    future.set_result(message)
+        except (OSError, ValueError, ProtocolError):
+            pass
+        finally:
+            self.close()
+
+    def send(self, message):
+        # Fire off a request and return a Future for its response
+        if self.closed:
+            raise ConnectionError(f"Connection to {self.peer} is closed")
+        future = Future()
+        message_id = next(self.ids)
+        self.pending[message_id] = future
+        try:
+            with self.send_lock:
+                send_frame(self.sock, dict(message, id=message_id))
+        except OSError:
+            self.pending.pop(message_id, None)
+            self.close()
+            raise
+        return future
+
+    def request(self, message, timeout=10):
+        return self.send(message).result(timeout)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        for message_id in list(self.pending):
+            future = self.pending.pop(message_id, None)
+            if future is not None and not future.done():
+                future.set_exception(ConnectionError(f"Connection to {self.peer} closed"))
+
+
+class ConnectionPool:
+    def __init__(self, connect_timeout=10, send_timeout=10):
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, peer):
+        peer = tuple(peer)
+        with self.lock:
+            conn = self.connections.get(peer)
+            if conn is not None and not conn.closed:
+                return conn
+        conn = PeerConnection(peer, self.connect_timeout, self.send_timeout)
+        with self.lock:
+            existing = self.connections.get(peer)
+            if existing is not None and not existing.closed:
+                # Somebody else connected first, keep theirs
+                conn.close()
+                return existing
+            self.connections[peer] = conn
+        return conn
+
+    def discard(self, peer):
+        with self.lock:
+            conn = self.connections.pop(tuple(peer), None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for conn in connections:
+            conn.close()
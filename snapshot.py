@@ -0,0 +1,93 @@
+import hashlib
+import os
+
+from encoding import COUNT, INT, LENGTH, Reader, pack_hash, pack_text
+
+# A snapshot file holds the account state at a height (see
+# ChainState.snapshot) followed by the sha256 of everything before it, so a
+# torn or corrupted file is noticed and skipped
+MAGIC = b"STATE2"
+DIGEST_SIZE = 32
+
+
+def pack_big(value):
+    # Cumulative work and targets outgrow 64 bits
+    data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return LENGTH.pack(len(data)) + data
+
+
+def encode_snapshot(snapshot):
+    parts = [
+        MAGIC,
+        INT.pack(snapshot["height"]),
+        pack_hash(snapshot["tip_hash"]),
+        pack_big(snapshot["work"]),
+        pack_big(snapshot["target"])
+    ]
+    for table in ("balances", "nonces"):
+        parts.append(COUNT.pack(len(snapshot[table])))
+        for key, value in snapshot[table].items():
+            # nonces has a None key, pack_text keeps it apart from any address
+            parts.append(pack_text(key))
+            parts.append(INT.pack(value))
+    data = b"".join(parts)
+    return data + hashlib.sha256(data).digest()
+
+
+def decode_snapshot(data):
+    data, digest = data[:-DIGEST_SIZE], data[-DIGEST_SIZE:]
+    if hashlib.sha256(data).digest() != digest:
+        raise ValueError("Snapshot checksum mismatch")
+    reader = Reader(data)
+    if reader.take(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a state snapshot")
+    snapshot = {
+        "height": reader.unpack(INT),
+        "tip_hash": reader.hash(),
+        "work": int.from_bytes(reader.take(reader.unpack(LENGTH)), "big"),
+        "target": int.from_bytes(reader.take(reader.unpack(LENGTH)), "big"),
+    }
+    for table in ("balances", "nonces"):
+        snapshot[table] = {}
+        for _ in range(reader.unpack(COUNT)):
+            key = reader.text()
+            snapshot[table][key] = reader.unpack(INT)
+    reader.done()
+    return snapshot
+
+
+class SnapshotStore:
+    def __init__(self, directory, keep=2):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, height):
+        return os.path.join(self.directory, f"state{height:010d}.snap")
+
+    def heights(self):
+        # Newest first
+        return sorted(
+            (int(name[5:-5]) for name in os.listdir(self.directory)
+             if name.startswith("state") and name.endswith(".snap")),
+            reverse=True
+        )
+
+    def save(self, snapshot):
+        path = self.path(snapshot["height"])
+        with open(path + ".tmp", "wb") as f:
+            f.write(encode_snapshot(snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)  # Never leave a half written snapshot behind
+        for height in self.heights()[self.keep:]:
+            os.remove(self.path(height))
+
+    def newest(self):
+        # Readable snapshots, newest first
+        for height in self.heights():
+            try:
+                with open(self.path(height), "rb") as f:
+                    yield decode_snapshot(f.read())
+            except (OSError, ValueError) as e:
+                print(f"[CHAIN] Skipping snapshot at height {height}: {e}")
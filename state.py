@@ -0,0 +1,94 @@
+from collections import defaultdict
+
+
+class ChainState:
+    def __init__(self, reward, max_undo=2000):
+        self.reward = reward
+        self.max_undo = max_undo
+        self.balances = defaultdict(int)
+        self.nonces = defaultdict(int)
+        self.height = 0  # number of blocks applied, like Node.get_height
+        self.tip_hash = None
+        self.work = 0  # cumulative work of the chain up to the tip
+        self.target = None  # the tip's proof of work target
+        # height -> {"balances": {...}, "nonces": {...}, "tip_hash": ...}
+        # holding the values the block at that height overwrote
+        self.journal = {}
+
+    def apply_block(self, block, block_hash=None, work=0, target=None):
+        undo = {"balances": {}, "nonces": {}, "tip_hash": self.tip_hash, "work": self.work, "target": self.target}
+
+        def credit(address, amount):
+            if address not in undo["balances"]:
+                undo["balances"][address] = self.balances.get(address)
+            self.balances[address] += amount
+
+        for transaction in block.transactions:
+            credit(transaction.recipient, transaction.amount)
+            credit(transaction.sender, -transaction.amount)
+            if transaction.sender not in undo["nonces"]:
+                undo["nonces"][transaction.sender] = self.nonces.get(transaction.sender)
+            self.nonces[transaction.sender] = transaction.nonce
+        credit(block.reward_to, self.reward)
+
+        self.height += 1
+        self.tip_hash = block_hash
+        self.work += work
+        self.target = target
+        self.journal[self.height] = undo
+        self.journal.pop(self.height - self.max_undo, None)
+
+    def rollback_block(self):
+        undo = self.journal.pop(self.height, None)
+        if undo is None:
+            raise ValueError(f"No undo data for height {self.height}")
+        for table, previous in ((self.balances, undo["balances"]), (self.nonces, undo["nonces"])):
+            for key, value in previous.items():
+                if value is None:
+                    table.pop(key, None)
+                else:
+                    table[key] = value
+        self.height -= 1
+        self.tip_hash = undo["tip_hash"]
+        self.work = undo["work"]
+        self.target = undo["target"]
+
+    def can_rollback(self, depth=1):
+        return all(self.height - i in self.journal for i in range(depth))
+
+    def snapshot(self, depth=0):
+        # The state as it was depth blocks below the tip, undone on copies
+        # from the journal
+        if not self.can_rollback(depth):
+            raise ValueError(f"No undo data {depth} block(s) below height {self.height}")
+        snapshot = {
+            "height": self.height - depth,
+            "tip_hash": self.tip_hash,
+            "work": self.work,
+            "target": self.target,
+            "balances": dict(self.balances),
+            "nonces": dict(self.nonces),
+        }
+        for height in range(self.height, self.height - depth, -1):
+            undo = self.journal[height]
+            for table in ("balances", "nonces"):
+                for key, value in undo[table].items():
+                    if value is None:
+                        snapshot[table].pop(key, None)
+                    else:
+                        snapshot[table][key] = value
+            snapshot["tip_hash"] = undo["tip_hash"]
+            snapshot["work"] = undo["work"]
+            snapshot["target"] = undo["target"]
+        return snapshot
+
+    @staticmethod
+    def from_snapshot(data, reward, max_undo=2000):
+        state = ChainState(reward, max_undo)
+        state.height = data["height"]
+        state.tip_hash = data["tip_hash"]
+        state.work = data.get("work", 0)
+        state.target = data.get("target")
+        state.balances.update(data["balances"])
+        state.nonces.update(data["nonces"])
+        return state
@@ -0,0 +1,179 @@
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+# Blocks are appended to numbered segment files as a 4 byte length followed by
+# the encoded block header and the encoded block, so headers can be served
+# without decoding blocks. index.dat holds one fixed-width (segment, offset,
+# header length, block length) entry per height, so opening a store only
+# reads the index.
+RECORD_HEADER = struct.Struct(">I")
+INDEX_ENTRY = struct.Struct(">IQII")
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class BlockStore:
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.maps = {}
+        os.makedirs(directory, exist_ok=True)
+
+        index_path = os.path.join(directory, "index.dat")
+        with open(index_path, "ab"):
+            pass
+        self.index = open(index_path, "r+b")
+        self.entries = bytearray(self.index.read())
+        # Drop a torn index entry left by a crash mid-write
+        del self.entries[len(self.entries) - len(self.entries) % INDEX_ENTRY.size:]
+        self.index.truncate(len(self.entries))
+        self.index.seek(0, os.SEEK_END)
+
+        if self.height:
+            segment, offset, header_length, length = self.entry(self.height - 1)
+            self._open_segment(segment, offset + header_length + length)
+        else:
+            self._open_segment(0, 0)
+
+    @property
+    def height(self):
+        return len(self.entries) // INDEX_ENTRY.size
+
+    def entry(self, height):
+        return INDEX_ENTRY.unpack_from(self.entries, height * INDEX_ENTRY.size)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"blk{segment:05d}.dat")
+
+    def _open_segment(self, segment, end):
+        path = self.segment_path(segment)
+        with open(path, "ab"):
+            pass
+        self.segment = segment
+        self.segment_end = end
+        self.segment_file = open(path, "r+b")
+        # Anything past the last indexed record was never committed
+        self.segment_file.truncate(end)
+        self.segment_file.seek(end)
+
+    def append(self, payload, header=b""):
+        with self.lock:
+            size = len(header) + len(payload)
+            if self.segment_end and self.segment_end + RECORD_HEADER.size + size > self.segment_size:
+                self.segment_file.close()
+                self._open_segment(self.segment + 1, 0)
+            offset = self.segment_end + RECORD_HEADER.size
+            self.segment_file.write(RECORD_HEADER.pack(size) + header + payload)
+            self.segment_file.flush()
+            self.segment_end = offset + size
+
+            entry = INDEX_ENTRY.pack(self.segment, offset, len(header), len(payload))
+            self.index.write(entry)
+            self.index.flush()
+            self.entries += entry
+
+    def read(self, height):
+        with self.lock:
+            m, offset, header_length, length = self._record(height)
+            return m[offset + header_length:offset + header_length + length]
+
+    def read_header(self, height):
+        with self.lock:
+            m, offset, header_length, _ = self._record(height)
+            return m[offset:offset + header_length]
+
+    def _record(self, height):
+        if not 0 <= height < self.height:
+            raise IndexError(f"No block at height {height}")
+        segment, offset, header_length, length = self.entry(height)
+        m = self.maps.get(segment)
+        if m is None or len(m) < offset + header_length + length:
+            # The segment grew since we mapped it
+            if m is not None:
+                m.close()
+            with open(self.segment_path(segment), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = m
+        return m, offset, header_length, length
+
+    def truncate(self, height):
+        # Drop every block from height up, e.g. when rolling back the tip
+        with self.lock:
+            if height >= self.height:
+                return
+            segment, offset, _, _ = self.entry(height)
+            # Unmap before shrinking files, touching a mapping past EOF is fatal
+            for s in [s for s in self.maps if s >= segment]:
+                self.maps.pop(s).close()
+            self.segment_file.close()
+            s = segment + 1
+            while os.path.exists(self.segment_path(s)):
+                os.remove(self.segment_path(s))
+                s += 1
+            self._open_segment(segment, offset - RECORD_HEADER.size)
+
+            del self.entries[height * INDEX_ENTRY.size:]
+            self.index.truncate(len(self.entries))
+            self.index.seek(0, os.SEEK_END)
+
+    def close(self):
+        with self.lock:
+            for m in self.maps.values():
+                m.close()
+            self.maps.clear()
+            self.segment_file.close()
+            self.index.close()
+
+
+class StoredChain:
+    # List-like view of the blocks in a BlockStore, decoding blocks on demand
+    # and keeping only the most recently used ones in memory
+    def __init__(self, store, encode, decode, encode_header, cache_size=256):
+        self.store = store
+        self.encode = encode
+        self.decode = decode
+        self.encode_header = encode_header
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return self.store.height
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        block = self.cache.get(i)
+        if block is None:
+            block = self.decode(self.store.read(i))
+            self._remember(i, block)
+        else:
+            self.cache.move_to_end(i)
+        return block
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _remember(self, i, block):
+        self.cache[i] = block
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def append(self, block):
+        self.store.append(self.encode(block), self.encode_header(block))
+        self._remember(len(self) - 1, block)
+
+    def pop(self):
+        block = self[-1]
+        height = len(self) - 1
+        self.store.truncate(height)
+        self.cache.pop(height, None)
+        return block
+
+    def __repr__(self):
+        return repr(list(self))
@@ -0,0 +1,124 @@
+import base64
+import functools
+import multiprocessing as mp
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from ecdsa import VerifyingKey, NIST256p, BadSignatureError
+
+
+@functools.lru_cache(maxsize=4096)
+def verifying_key(sender):
+    # Parsing the point is a large share of a pure-Python verify, and the
+    # same senders show up over and over again
+    return VerifyingKey.from_string(base64.b64decode(sender), curve=NIST256p)
+
+
+def verify_signature(sender, signature, message):
+    if not signature or not sender:
+        return False
+    try:
+        return verifying_key(sender).verify(base64.b64decode(signature), message)
+    except (BadSignatureError, ValueError):
+        return False
+
+
+def _verify_chunk(items):
+    # Returns the index of the first bad signature in the chunk, or -1
+    for i, (sender, signature, message) in enumerate(items):
+        if not verify_signature(sender, signature, message):
+            return i
+    return -1
+
+
+class VerifiedCache:
+    # LRU set of (transaction hash, signature) pairs that verified fine
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self.lock:
+            self.entries[key] = None
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+class SignatureVerifier:
+    def __init__(self, processes=None, chunk_size=32, min_parallel=64, cache_size=100000):
+        self.processes = processes or mp.cpu_count()
+        self.chunk_size = chunk_size
+        self.min_parallel = min_parallel  # below this IPC costs more than it saves
+        self.cache = VerifiedCache(cache_size)
+        self.executor = None
+
+    def check(self, transaction):
+        message = transaction.generate_hash()
+        key = (message, transaction.signature)
+        if self.cache.lookup(key):
+            return True
+        if not verify_signature(transaction.sender, transaction.signature, message):
+            return False
+        self.cache.add(key)
+        return True
+
+    def verify(self, transactions):
+        items = []
+        for tx in transactions:
+            message = tx.generate_hash()
+            if not self.cache.lookup((message, tx.signature)):
+                items.append((tx.sender, tx.signature, message))
+
+        if not self._verify_items(items):
+            return False
+        for _, signature, message in items:
+            self.cache.add((message, signature))
+        return True
+
+    def _verify_items(self, items):
+        if self.processes <= 1 or len(items) < self.min_parallel:
+            return _verify_chunk(items) == -1
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.processes)
+        futures = []
+        try:
+            for i in range(0, len(items), self.chunk_size):
+                futures.append(self.executor.submit(_verify_chunk, items[i:i + self.chunk_size]))
+            for future in as_completed(futures):
+                if future.result() != -1:
+                    return False
+            return True
+        except BrokenProcessPool:
+            # A worker died, start a fresh pool next time and check these here
+            print("[CHAIN] Signature verifier pool broke, verifying in process")
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+            return _verify_chunk(items) == -1
+        finally:
+            # Short-circuit: drop whatever has not started yet
+            for future in futures:
+                future.cancel()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None